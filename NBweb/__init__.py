@@ -46,6 +46,8 @@ def cli(argv=None):
         help="Initialize the noteboook here if it doesn't exists")
     parser.add_argument('--todo',action='store_true',\
         help='Prints the todo page to stdout and exits. Note: if `--refresh`, counts are printed to stderr')
+    parser.add_argument('--broken-links',action='store_true',\
+        help='Prints the links that do not go to a page to stdout and exits. Use with `--refresh` to update first')
     parser.add_argument('--no-launch',action='store_true',\
         help='Do not launch the server. Useful to refresh before `--todo`')
     parser.add_argument('--open',action='store_true',
@@ -55,6 +57,11 @@ def cli(argv=None):
         help='Will refresh any modified files before launching')
     parser.add_argument('--reset',action='store_true',\
         help='Will remove the old DB and then refresh entire DB before launching')
+    parser.add_argument('--index-only',action='store_true',\
+        help=('Refresh (implies `--refresh`) only the index: titles, tags, todos, links and search text. '
+              'The HTML of changed pages is rendered when they are first viewed'))
+    parser.add_argument('-j','--jobs',action='store',type=int,default=1,metavar='N',\
+        help='[1] Number of processes to render with when using `--refresh` or `--reset`')
 
     #parser.add_argument('--export',action='store',\
     #    help='Export a static copy to the specified directory')
@@ -97,11 +104,15 @@ def cli(argv=None):
 
     if args.reset:
         DBpath = os.path.join(NBCONFIG.scratch_path,'DB.sqlite')
-        try:
-            os.remove(DBpath)
-        except OSError:
-            pass
+        for path in [DBpath,DBpath + '-wal',DBpath + '-shm']: # WAL files too
+            try:
+                os.remove(path)
+            except OSError:
+                pass
         args.refresh = True # Override
+
+    if args.index_only:
+        args.refresh = True
     
     from . import utils
     from . import main # Will then also parse the config
@@ -116,7 +127,7 @@ def cli(argv=None):
 
     if args.refresh:
         main.init_db()
-        main.parse_all()
+        main.parse_all(jobs=args.jobs,metadata_only=args.index_only)
 
 #     if args.export is not None:
 #         offline_copy.offline_copy(args.export)
@@ -126,6 +137,11 @@ def cli(argv=None):
         sys.stdout.write(main.return_todo_txt()+'\n')
         sys.exit()
 
+    if args.broken_links:
+        main.init_db() # Make sure the link tables exist
+        sys.stdout.write(main.broken_links_txt()+'\n')
+        sys.exit()
+
     if args.open:
         # The defaults come fromt bottle.run's defaults
         host = NBCONFIG.web_server.get('host','127.0.0.1')
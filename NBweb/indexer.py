@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Index maintenance outside of page views:
+
+* Multi-process rendering for parse_all. Rendering (markdown, link
+  conversion, search text) is done in a process pool while the calling
+  process remains the only one writing to the DB.
+* A source watcher thread that reparses only the files that changed
+* A background, prioritized, and resumable reindex job (for `/_refresh`)
+
+Note that this module must *not* import main at the top since (spawned)
+workers need to parse the config before main can be imported
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os
+import sys
+import time
+import threading
+import traceback
+import multiprocessing
+from collections import OrderedDict
+
+# Optional. Uses inotify (or the OS equivalent) if installed. Otherwise poll
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+    _watchdog = True
+except ImportError:
+    FileSystemEventHandler = object
+    _watchdog = False
+
+from .nbconfig import NBCONFIG
+from . import utils
+
+def _init_worker(config_filename):
+    """
+    Parse the config in the worker. Forked workers already have it but
+    spawned ones (e.g. macOS, Windows) start fresh
+    """
+    if not NBCONFIG._parsed and config_filename is not None:
+        NBCONFIG._parse(config_filename)
+
+def _render_worker(args):
+    systempath,new,metadata_only = args
+    from . import main
+    return main.render_path(systempath,metadata_only=metadata_only),new
+
+def render_paths(paths,jobs=None,chunksize=8,metadata_only=False):
+    """
+    Render (systempath,new) pairs in a pool of `jobs` processes. Yields
+    (item,new) *in the same order* as paths
+    """
+    pool = multiprocessing.Pool(processes=jobs,initializer=_init_worker,
+                                initargs=(NBCONFIG.filename,))
+    args = ((systempath,new,metadata_only) for systempath,new in paths)
+    try:
+        for res in pool.imap(_render_worker,args,chunksize=chunksize):
+            yield res
+    except:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+class SourceWatcher(object):
+    """
+    Keep the DB fresh by watching the source for created, modified, moved and
+    deleted files and (re)parsing only those. Uses watchdog (inotify, etc) if
+    it is installed and otherwise polls the mtimes of the source files.
+
+    Changes are collected and processed together every `interval` seconds so
+    that a burst of events (e.g. `git pull`) is only handled once. Polling
+    stats every file so it is only done every `poll_interval` seconds. The
+    link authorities are a full recompute so they are only updated (if the
+    links changed) every `authority_interval` seconds.
+
+    Use:
+        SourceWatcher(interval=5,poll_interval=300,authority_interval=300).start()
+    """
+    def __init__(self,interval=5,poll_interval=300,authority_interval=300):
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self.authority_interval = authority_interval
+        self._last_poll = 0
+        self._last_authority = time.time()
+        self._lock = threading.Lock()
+        self._changed = set()  # files and dirs. Parsed or purged based on existence
+        self._snapshot = None  # polling only. {systempath:mtime}
+
+    def start(self):
+        if _watchdog:
+            observer = Observer()
+            observer.schedule(_WatchdogHandler(self),NBCONFIG.source,recursive=True)
+            observer.daemon = True
+            observer.start()
+        else:
+            self._snapshot = self._poll_snapshot()
+            self._last_poll = time.time()
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True # So that it will exit when we quit later
+        thread.start()
+        return self
+
+    def add(self,systempath,isdir=None):
+        """
+        Queue a changed path. Safe to call from any thread. isdir is whether it
+        is a directory if known (e.g. from the event). Otherwise it is checked
+        """
+        if self._ignored(systempath,isdir=isdir):
+            return
+        with self._lock:
+            self._changed.add(systempath)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self._snapshot is not None \
+                        and time.time() - self._last_poll >= self.poll_interval:
+                    self._last_poll = time.time()
+                    self._poll()
+                with self._lock:
+                    changed,self._changed = self._changed,set()
+                if len(changed) > 0:
+                    self.process(changed)
+                if time.time() - self._last_authority >= self.authority_interval:
+                    self._last_authority = time.time()
+                    self.update_authority()
+            except Exception:
+                sys.stderr.write('Source watcher error:\n' + traceback.format_exc())
+
+    def process(self,changed):
+        """
+        Parse the files that exist and purge the ones that do not. Directories
+        that exist (e.g. moved into the source) are walked
+        """
+        from . import main
+
+        db = main.db_conn()
+        for systempath in sorted(changed):
+            if os.path.isdir(systempath):
+                for dirpath,dirnames,filenames in main.walk(systempath):
+                    for dirname in dirnames[:]:
+                        if main.exclusion_check(main.get_rootname(dirpath,dirname),isdir=True):
+                            dirnames.remove(dirname)
+                    for filename in filenames:
+                        path = utils.join(dirpath,filename)
+                        if not self._ignored(path,isdir=False):
+                            main.parse_path(path,db,commit=False,content=False)
+            elif os.path.exists(systempath):
+                main.parse_path(systempath,db,commit=False,content=False)
+            else:
+                # Deleted (or moved away). May have been a file or directory
+                rootname = main.get_rootname(systempath)
+                # Exact prefix: LIKE has wildcards and ignores case
+                prefix = rootname + '/'
+                db.execute("""DELETE FROM file_db
+                              WHERE rootname=? OR substr(rootname,1,length(?))=?""",
+                              (rootname,prefix,prefix))
+        db.commit()
+        db.close()
+
+    def update_authority(self):
+        """Update the link authorities if the links changed since the last time"""
+        from . import main
+
+        db = main.db_conn()
+        main.search.update_authority(db) # Only if stale
+        db.commit()
+        db.close()
+
+    def _ignored(self,systempath,isdir=None):
+        """
+        Whether systempath is outside of what is parsed. Checks every
+        directory since a single event does not go through the walk.
+        Directories (isdir, or checked if None) are not held to the extensions
+        """
+        rootname = os.path.relpath(systempath,NBCONFIG.source)
+        if rootname == '.' or rootname.startswith('..'):
+            return True
+        parts = rootname.split(os.sep)
+        for ii in range(1,len(parts)):
+            if utils.patterns_check('/'.join(parts[:ii]) + '/',patterns=NBCONFIG.exclusions):
+                return True
+        if utils.patterns_check(rootname,patterns=NBCONFIG.exclusions):
+            return True
+
+        if isdir is None:
+            isdir = os.path.isdir(systempath) # False if deleted. See add
+        if isdir:
+            return utils.patterns_check(rootname + '/',patterns=NBCONFIG.exclusions)
+
+        ext = os.path.splitext(systempath)[-1]
+        # A deleted directory without isdir may still not have an extension
+        return ext != '' and ext not in NBCONFIG.extensions
+
+    def _poll_snapshot(self):
+        """{systempath:mtime} of all parsed files"""
+        from . import main
+        snapshot = {}
+        for dirpath,dirnames,filenames in main.walk(NBCONFIG.source):
+            for dirname in dirnames[:]:
+                if main.exclusion_check(main.get_rootname(dirpath,dirname),isdir=True):
+                    dirnames.remove(dirname)
+            for filename in filenames:
+                if os.path.splitext(filename)[-1] not in NBCONFIG.extensions:
+                    continue
+                systempath = utils.join(dirpath,filename)
+                if main.exclusion_check(main.get_rootname(systempath)):
+                    continue
+                try:
+                    snapshot[systempath] = os.path.getmtime(systempath)
+                except OSError:
+                    pass # deleted during the walk
+        return snapshot
+
+    def _poll(self):
+        """Compare to the last snapshot and queue the differences"""
+        snapshot = self._poll_snapshot()
+        old = self._snapshot
+        with self._lock:
+            for systempath,mtime in snapshot.items():
+                if old.get(systempath) != mtime:
+                    self._changed.add(systempath) # new or modified
+            for systempath in set(old) - set(snapshot):
+                self._changed.add(systempath)     # deleted or moved
+        self._snapshot = snapshot
+
+class _WatchdogHandler(FileSystemEventHandler):
+    def __init__(self,watcher):
+        self.watcher = watcher
+
+    def on_any_event(self,event):
+        if event.event_type not in ['created','modified','moved','deleted']:
+            return
+        if event.is_directory and event.event_type == 'modified':
+            return # The files themselves will have events
+
+        self.watcher.add(event.src_path,isdir=event.is_directory)
+        if event.event_type == 'moved':
+            self.watcher.add(event.dest_path,isdir=event.is_directory)
+
+# Recently viewed rootnames (most recent last). Filled by main_route and
+# used to prioritize the reindex job
+RECENT_VIEWS = OrderedDict()
+RECENT_VIEWS_MAX = 1000
+
+def record_view(rootname):
+    RECENT_VIEWS.pop(rootname,None)
+    RECENT_VIEWS[rootname] = time.time()
+    while len(RECENT_VIEWS) > RECENT_VIEWS_MAX:
+        RECENT_VIEWS.popitem(last=False)
+
+class ReindexJob(object):
+    """
+    Reindex the source in a background thread. The changed files (from the
+    directory manifest) are queued in the reindex_queue table of the DB with
+    a priority:
+
+        0 : Recently viewed pages
+        1 : Blogged pages
+        2 : Everything else
+
+    and then parsed in that order in batches. Each batch is committed with
+    the queue so a killed server picks up where it left off (see main.start).
+    Once the queue is done, deleted pages are purged and the queue cleared.
+
+    Queue `done` values: 0 pending, 1 parsed, 2 unchanged (not parsed), and
+    3 purge (in the DB when queued but not found by the walk). Only purge
+    rows are deleted from the DB so pages added during the job are kept
+
+    Use the module-level REINDEX instance
+    """
+    batch_size = 50
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.started = None
+        self.parsed = 0 # since started. For the rate
+        self.error = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self,force=False):
+        """
+        Start the job if it is not already running. If there is a queue from
+        a previous (killed) run, it is resumed. Returns whether it was started
+        """
+        with self._lock:
+            if self.running:
+                return False
+            self.started = time.time()
+            self.parsed = 0
+            self.error = None
+            self._thread = threading.Thread(target=self._run,kwargs={'force':force})
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    @staticmethod
+    def pending(db):
+        """Whether there is an unfinished queue in the DB"""
+        return db.execute('SELECT 1 FROM reindex_queue LIMIT 1').fetchone() is not None
+
+    def status(self,db):
+        """
+        Dictionary of the job status
+        """
+        counts = dict((row['done'],row['N']) for row in db.execute(
+                    'SELECT done,COUNT(*) AS N FROM reindex_queue GROUP BY done'))
+        elapsed = time.time() - self.started if self.started else 0.0
+        return {'running':self.running,
+                'done':counts.get(1,0),
+                'remaining':counts.get(0,0),
+                'unchanged':counts.get(2,0),
+                'elapsed':elapsed,
+                'rate':self.parsed/elapsed if elapsed > 0 else 0.0, # files/s
+                'error':self.error}
+
+    def _run(self,force=False):
+        from . import main
+
+        db = main.db_conn()
+        try:
+            if not self.pending(db):
+                self._enqueue(db,force=force)
+            self._process(db,force=force)
+        except Exception:
+            self.error = traceback.format_exc()
+            sys.stderr.write('Reindex error:\n' + self.error)
+        finally:
+            db.close()
+
+    def _enqueue(self,db,force=False):
+        from . import main
+
+        recent = set(RECENT_VIEWS)
+        rows = []
+        for systempath,rootname,changed in main.walk_source(db,reset=force):
+            if not changed:
+                rows.append((rootname,systempath,2,2))
+            elif rootname in recent:
+                rows.append((rootname,systempath,0,0))
+            elif utils.patterns_check(rootname,patterns=NBCONFIG.blog_dirs):
+                rows.append((rootname,systempath,1,0))
+            else:
+                rows.append((rootname,systempath,2,0))
+
+            if len(rows) >= 1000:
+                db.executemany('INSERT OR REPLACE INTO reindex_queue VALUES (?,?,?,?)',rows)
+                del rows[:]
+        db.executemany('INSERT OR REPLACE INTO reindex_queue VALUES (?,?,?,?)',rows)
+
+        # Unchanged files may still be missing from the DB (see parse_all)
+        db.execute("""UPDATE reindex_queue SET done=0 WHERE done=2 AND NOT EXISTS (
+                        SELECT 1 FROM file_db
+                        WHERE file_db.rootname = reindex_queue.rootname)""")
+
+        # Snapshot the pages to purge now. Anything added later is not in it
+        db.execute("""INSERT INTO reindex_queue
+                        SELECT rootname,systempath,3,3 FROM file_db
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM reindex_queue
+                            WHERE reindex_queue.rootname = file_db.rootname)""")
+
+        # The queue makes sure the changed files get parsed even if killed so
+        # the manifest can be saved with it
+        main.save_manifest(db)
+        db.commit()
+
+    def _process(self,db,force=False):
+        from . import main
+
+        while True:
+            batch = db.execute("""SELECT rootname,systempath FROM reindex_queue
+                                  WHERE done=0
+                                  ORDER BY priority,rowid
+                                  LIMIT ?""",(self.batch_size,)).fetchall()
+            if len(batch) == 0:
+                break
+
+            for row in batch:
+                if os.path.exists(row['systempath']):
+                    main.parse_path(row['systempath'],db,commit=False,force=force,
+                                    content=False)
+                else: # Deleted since queued
+                    db.execute('DELETE FROM file_db WHERE rootname=?',(row['rootname'],))
+                self.parsed += 1
+            db.executemany('UPDATE reindex_queue SET done=1 WHERE rootname=?',
+                           [(row['rootname'],) for row in batch])
+            db.commit() # Checkpoint
+
+        # Purge deleted files from the DB (unless they were since recreated)
+        # and clear the queue
+        purge = db.execute('SELECT rootname,systempath FROM reindex_queue WHERE done=3').fetchall()
+        db.executemany('DELETE FROM file_db WHERE rootname=?',
+                       [(row['rootname'],) for row in purge
+                        if not os.path.exists(row['systempath'])])
+        db.execute('DELETE FROM reindex_queue')
+        db.commit()
+        main.search.update_authority(db)
+        db.commit()
+
+REINDEX = ReindexJob()
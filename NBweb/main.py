@@ -26,6 +26,7 @@ import gc
 import logging
 import sqlite3
 import hashlib
+import threading
 
 # 3rd party
 
@@ -53,6 +54,9 @@ else:
 if sys.version_info[0] >= 3:
     unicode = str
     xrange = range
+    from urllib.request import pathname2url
+else:
+    from urllib import pathname2url
 
 
 # part of NBweb
@@ -62,6 +66,7 @@ from . import todo_tags
 from . import search
 from . import bottlesession
 from . import ipynb
+from . import indexer
 from .photo_sort import photo_sort
 from .photo_parse import photo_parse
 
@@ -113,6 +118,9 @@ re_todo = re.compile('[\*|-] \[ \] (.+)')
 re_links = re.compile('href="(.+?)"',re.IGNORECASE)
 
         # ('id','int'),         ### id is TEMP. Will remove later and use rowid
+# Columns of file_db. A new column also needs a step in MIGRATIONS.
+# file_db is only the (narrow) page metadata. The rendered html is in
+# file_content and the search text in file_search, both keyed by rootname
 SCHEMA = [('systempath', 'text'),
           ('rootname', 'text PRIMARY KEY'),
           ('rootdirname', 'text'),
@@ -131,10 +139,25 @@ SCHEMA = [('systempath', 'text'),
           ('tags', 'text'),
           ('blog_date', 'text'),
           ('blogged', 'int'),
-          ('html', 'text'),
           ('outgoing_links', 'text'),
-          ('stext', 'text'),
-          ('meta_draft', 'text')]
+          ('meta_draft', 'text'),
+          ('content_hash', 'text'),
+          ('html_deferred', 'int'),
+          ('page_date', 'real')]
+
+# Indexes on file_db as (name,columns). rootname is already the PRIMARY KEY.
+# Any other `idx_file_db_*` index in the DB is dropped by update_indexes so
+# change an index by renaming it (and add a migration that calls it).
+#   - rootdirname is NOCASE so that (case-insensitive) `LIKE '/dir/%'` can use it
+#   - blog_date is stored as text so sort on it CAST as a number. Queries must
+#     use the same expression: `ORDER BY CAST(blog_date AS REAL) DESC`
+#   - page_date is the meta date as a timestamp for search `date:` filters
+INDEXES = [('idx_file_db_rootbasename','rootbasename'),
+           ('idx_file_db_meta_id','meta_id'),
+           ('idx_file_db_blog','blogged,CAST(blog_date AS REAL)'),
+           ('idx_file_db_rootdirname','rootdirname COLLATE NOCASE'),
+           ('idx_file_db_draft','draft'),
+           ('idx_file_db_page_date','page_date')]
 
 ################### Parsing
 # Define markdown parser. Also inject it into NBCONFIG
@@ -142,58 +165,238 @@ MD = utils.mmd_(automatic_line_breaks=NBCONFIG.automatic_line_breaks)
 NBCONFIG.MD = MD
 
 # Parsing
-def parse_all(reset=False):
+def parse_all(reset=False,jobs=1,metadata_only=False):
+    """
+    Walk the source and parse every modified file into the DB. Also purges
+    deleted files from the DB.
+
+    Options:
+        reset         : [False] Reparse every file regardless of mtime
+        jobs          : [1] Number of processes to render with. If > 1, the
+                        files that need parsing are rendered in a process pool
+                        and the rows are written here (a single writer) with
+                        the BatchWriter.
+        metadata_only : [False] Only index the metadata, todos, tags, links,
+                        and search text from the source. The HTML is rendered
+                        on first view. See render_path
+    """
     db = db_conn()
 
     count = 0
 
-    rootnames = set()
-    for dirpath, dirnames, filenames in walk(NBCONFIG.source):
-        # directory exclusions
-        for dirname in dirnames[:]: # Loop over copy
-            rootname = get_rootname(dirpath,dirname)
-            if exclusion_check(rootname,isdir=True):
-                dirnames.remove(dirname)
-
-        for filename in filenames:
-            rootname = get_rootname(dirpath,filename)
-            if exclusion_check(rootname,isdir=False):
-                continue
-            rootnames.add(rootname) # Track all rootnames to handle deletions
-
-            systempath = utils.join(dirpath,filename)
-            item = parse_path(systempath,db,commit=False,force=reset)
-            if item is not None and not item['cached']:
-                count += 1
-                txt = 'Proc {}'.format(count)
-                sys.stderr.write('\r%s' % txt)
-                sys.stderr.flush()
-
-    # Purge deleted files from the DB
-    rootnames_DB = set(item['rootname'] for item in
-                    db.execute('SELECT rootname FROM file_db'))
-
-    for deleted_rootname in (rootnames_DB - rootnames):
-        cursor = db.cursor()
-        cursor.execute('''DELETE FROM file_db WHERE
-                          rootname=?''',[deleted_rootname])
-        cursor.close()
+    # Track all rootnames in a temp table to handle deletions. Buffered so they
+    # can be inserted with executemany
+    db.execute('DROP TABLE IF EXISTS temp.walked')
+    db.execute('CREATE TEMP TABLE walked(rootname text PRIMARY KEY,systempath text)')
+    walked = []
+
+    pending = [] # (systempath,new) to be rendered by the pool
+    def process(systempath):
+        if jobs > 1:
+            status,_ = check_path(systempath,db,force=reset,metadata_only=metadata_only)
+            if status in ['new','update']:
+                pending.append((systempath,status == 'new'))
+            return 0
+        item = parse_path(systempath,db,commit=False,force=reset,
+                          metadata_only=metadata_only,content=False)
+        if item is not None and not item['cached']:
+            return 1
+        return 0
+
+    for systempath,rootname,changed in walk_source(db,reset=reset):
+        walked.append((rootname,systempath))
+        if len(walked) >= 1000:
+            db.executemany('INSERT INTO temp.walked VALUES (?,?)',walked)
+            del walked[:]
+
+        if not changed: # Same mtime as the last run. Skip the DB lookup
+            continue
 
+        if process(systempath):
+            count += 1
+            txt = 'Proc {}'.format(count)
+            sys.stderr.write('\r%s' % txt)
+            sys.stderr.flush()
+    db.executemany('INSERT INTO temp.walked VALUES (?,?)',walked)
+    del walked[:]
+
+    # Unchanged files may still be missing from the DB if their rows were
+    # deleted some other way (e.g. the watcher). Parse those too. One anti-join
+    db.writer.flush(commit=False)
+    queued = set(systempath for systempath,_ in pending)
+    missing = [row['systempath'] for row in db.execute('''
+                    SELECT systempath FROM temp.walked WHERE NOT EXISTS (
+                        SELECT 1 FROM file_db
+                        WHERE file_db.rootname = walked.rootname)''').fetchall()]
+    for systempath in missing:
+        if systempath not in queued and process(systempath):
+            count += 1
+            sys.stderr.write('\rProc {}'.format(count))
+            sys.stderr.flush()
+
+    if jobs > 1 and len(pending) > 0:
+        # imap is ordered so rows go in exactly as they would serially
+        for item,new in indexer.render_paths(pending,jobs=jobs,metadata_only=metadata_only):
+            db.writer.add(item,new)
+            count += 1
+            sys.stderr.write('\rProc {}'.format(count))
+            sys.stderr.flush()
+        del pending
+
+    # Purge deleted files from the DB with one anti-join
+    db.execute('''DELETE FROM file_db WHERE NOT EXISTS (
+                    SELECT 1 FROM temp.walked
+                    WHERE walked.rootname = file_db.rootname)''')
+    db.execute('DELETE FROM temp.walked')
+
+    save_manifest(db) # Only now that all of the files are in the DB
+    db.commit()
+    search.update_authority(db) # Now that all of the links are written
     db.commit()
     db.close()
 
     # Explicitly clear some variables (just to be safe)
-    #del DB
-    del rootnames_DB
-    del rootnames
+    del walked
     gc.collect()
-    print('')
+    sys.stderr.write('\n') # End the progress line
+
+def walk_source(db,reset=False):
+    """
+    Walk the (non-excluded) source and yield (systempath,rootname,changed) for
+    every file.
+
+    Uses the directory manifest (dir_manifest table) from the last walk:
+    directories with the same mtime are not listed again and files with the
+    same mtime are yielded with changed=False so they can be skipped without a
+    DB lookup. Note that editing a file in place does not change the mtime of
+    its directory so every file is still stat'ed.
+
+    The new manifest is written to temp.new_manifest. Call save_manifest once
+    the changed files are in the DB. If reset, the manifest is not read and
+    all files are changed
+    """
+    db.execute('''CREATE TEMP TABLE IF NOT EXISTS new_manifest(
+                    rootdirname text PRIMARY KEY,
+                    mtime real,
+                    dirnames text,
+                    files text)''')
+    db.execute('DELETE FROM temp.new_manifest')
+
+    stack = [NBCONFIG.source]
+    while len(stack) > 0:
+        dirpath = stack.pop()
+        rootdirname = get_rootname(dirpath)
+        try:
+            dir_mtime = os.path.getmtime(dirpath) # *before* listing
+        except OSError:
+            continue # Removed during the walk
+
+        old = None
+        if not reset:
+            old = db.execute('''SELECT * FROM dir_manifest
+                                WHERE rootdirname=?''',(rootdirname,)).fetchone()
+        old_files = json.loads(old['files']) if old is not None else {}
+
+        if old is not None and old['mtime'] == dir_mtime:
+            # Nothing added, removed, or renamed here. Use the old listing
+            dirnames = json.loads(old['dirnames'])
+            filenames = list(old_files)
+        else:
+            dirnames,filenames = [],[]
+            try:
+                if _scandir:
+                    for entry in scandir(dirpath):
+                        (dirnames if entry.is_dir() else filenames).append(entry.name)
+                else:
+                    for name in os.listdir(dirpath):
+                        isdir = os.path.isdir(utils.join(dirpath,name))
+                        (dirnames if isdir else filenames).append(name)
+            except OSError:
+                continue
+
+        # Exclusions are applied even to the old listing in case they changed.
+        # The manifest stores *all* names and None for excluded file mtimes
+        files = {}
+        for filename in sorted(filenames):
+            rootname = rootdirname + filename
+            if exclusion_check(rootname,isdir=False):
+                files[filename] = None
+                continue
+            systempath = utils.join(dirpath,filename)
+            try:
+                mtime = os.path.getmtime(systempath)
+            except OSError:
+                continue # Removed since listed
+            files[filename] = mtime
+            yield systempath,rootname,reset or old_files.get(filename) != mtime
+
+        db.execute('''INSERT OR REPLACE INTO temp.new_manifest
+                      VALUES (?,?,?,?)''',
+                   (rootdirname,dir_mtime,json.dumps(dirnames),json.dumps(files)))
+
+        for dirname in sorted(dirnames,reverse=True): # reversed for the stack
+            if exclusion_check(rootdirname + dirname,isdir=True):
+                continue
+            stack.append(utils.join(dirpath,dirname))
+
+def save_manifest(db):
+    """
+    Replace the directory manifest with the one from the last walk_source.
+    Does not commit
+    """
+    db.execute('DELETE FROM dir_manifest')
+    db.execute('INSERT INTO dir_manifest SELECT * FROM temp.new_manifest')
+    db.execute('DELETE FROM temp.new_manifest')
 
-def parse_path(systempath,db,commit=True,force=False):
+def parse_path(systempath,db,commit=True,force=False,metadata_only=False,
+               content=True):
     """
     Parse and add to the DB. systempath should the *system* path of the file
 
-    Returns the DB entry so that you do not need to reparse it later
+    Returns the DB entry so that you do not need to reparse it later.
+
+    The row is added to the connection's BatchWriter (db.writer) so it may not
+    be written until the batch is full or db.commit()/db.close(). If commit
+    is False, a full batch is written but not committed.
+
+    If metadata_only, the HTML is not rendered (see render_path). Otherwise,
+    entries without HTML are rendered even if the file is unchanged.
+
+    If not content, unchanged entries are returned without their HTML (only
+    the file_db metadata). Use for listings
+    """
+    status,found = check_path(systempath,db,force=force,metadata_only=metadata_only)
+    if status == 'skip':
+        return
+    if status in ['cached','touched']:
+        if status == 'touched' and commit:
+            db.commit()
+        if content:
+            load_html(found,db)
+        return found
+
+    item = render_path(systempath,metadata_only=metadata_only)
+    db.writer.add(item,status == 'new',commit=commit)
+
+    item['cached'] = False # Not in the DB but useful
+    return item
+
+def check_path(systempath,db,force=False,metadata_only=False):
+    """
+    Determine if systempath needs to be (re)parsed. Returns (status,found):
+
+        'skip'    : Not a parsed file (extension or exclusion). found is None
+        'cached'  : The DB entry is current. found is the DB entry
+        'touched' : Only the mtime changed. The DB mtime was updated (but not
+                    committed). Otherwise the same as 'cached'
+        'new'     : Not in the DB. found is None
+        'update'  : In the DB but out of date (or forced). found is the DB entry
+
+    Change detection is two stages. First the (exact) mtime and the size. If
+    the mtime changed but not the size, the content hash is compared so that,
+    for example, a `git pull` that touches files does not rerender them.
+
+    Unless metadata_only, entries whose HTML was deferred are 'update'
     """
     if not os.path.exists(systempath):
         # Even if it is in the DB, this check comes first
@@ -202,26 +405,68 @@ def parse_path(systempath,db,commit=True,force=False):
     parts = utils.fileparts(systempath,root=NBCONFIG.source)
 
     if parts.ext not in NBCONFIG.extensions:
-        return
+        return 'skip',None
 
     # Shouldn't happen but just in case
     if exclusion_check(parts.rootname,isdir=False):
-        return
+        return 'skip',None
 
-    mtime = os.path.getmtime(systempath)
+    stat = os.stat(systempath)
+    mtime = stat.st_mtime
+
+    # Rendered but possibly not yet written. See BatchWriter
+    pending = db.writer.get(parts.rootname)
+    if pending is not None and not force and pending['mtime'] == mtime \
+            and (metadata_only or not pending['html_deferred']):
+        pending = pending.copy()
+        pending['cached'] = True
+        return 'cached',pending
 
     found = db.execute('SELECT * FROM file_db where rootname=?',(parts.rootname,)).fetchall()
     if len(found) == 1:
-        if not force and abs( found[0]['mtime'] - mtime ) <= 1:
-            found[0]['cached'] = True
-            return found[0]
-    elif len(found) > 1:
+        found = found[0]
+        if force:
+            return 'update',found
+        if found['html_deferred'] and not metadata_only:
+            return 'update',found
+
+        content_hash = found['content_hash']
+        if content_hash is None: # Entries from before content hashes
+            if found['mtime'] == mtime:
+                found['cached'] = True
+                return 'cached',found
+            return 'update',found
+
+        if int(content_hash.split(':',1)[0]) != stat.st_size:
+            return 'update',found
+        if found['mtime'] == mtime:
+            found['cached'] = True
+            return 'cached',found
+        if utils.file_hash(systempath) == content_hash:
+            if not db.readonly:
+                db.execute('UPDATE file_db SET mtime=? WHERE rootname=?',(mtime,parts.rootname))
+            found['mtime'] = mtime
+            found['cached'] = True
+            return 'touched',found
+        return 'update',found
+    elif len(found) > 1 and not db.readonly:
         print('ERROR: Duplicate entry for {}. Removing all'.format(parts.rootname))
         db.execute('''DELETE FROM file_db WHERE
                           rootname=?''',[parts.rootname])
         db.commit() # Commit no matter what
-        return parse_path(systempath,db,commit=commit)
+    return 'new',None
 
+def render_path(systempath,metadata_only=False):
+    """
+    Read and render systempath into a DB item (as a dict). This does *not*
+    touch the DB so it can be done in another process (see indexer.py)
+
+    If metadata_only, the markdown is *not* rendered. The links and search
+    text come straight from the source and the item is marked with
+    html_deferred so the HTML is rendered on first view (see ensure_html)
+    """
+    parts = utils.fileparts(systempath,root=NBCONFIG.source)
+    mtime = os.path.getmtime(systempath)
 
     item = OrderedDict()
 
@@ -236,6 +481,7 @@ def parse_path(systempath,db,commit=True,force=False):
     item['basename'] = parts.basename           # page1
 
     item['mtime'] = mtime
+    item['content_hash'] = utils.file_hash(systempath)
 
     # Get the actual text
     if item['ext'] == '.ipynb':
@@ -243,7 +489,7 @@ def parse_path(systempath,db,commit=True,force=False):
     else:
         filetext,meta = utils.parse_file(systempath)
 
-    if parts.ext == '.gallery':
+    if parts.ext == '.gallery' and not metadata_only:
         filetext = photo_parse(filetext,meta,NBCONFIG)
 
     # Store the metadata as meta_key for allowed keys
@@ -253,7 +499,9 @@ def parse_path(systempath,db,commit=True,force=False):
         if key in meta_keys:
             if isinstance(value,(str,unicode)):
                 item['meta_'+key] = value
-            elif isinstance(value,(set,tuple,list)):
+            elif isinstance(value,set): # sorted so it doesn't depend on hash seed
+                item['meta_'+key] = ','.join(sorted(value))
+            elif isinstance(value,(tuple,list)):
                 item['meta_'+key] = ','.join(value)
             else:
                 item['meta_'+key] = repr(value)
@@ -295,6 +543,8 @@ def parse_path(systempath,db,commit=True,force=False):
     tags = item.get('meta_tags','').split(',') + re_tags.findall(filetext)
     item['tags'] = ','.join(tags) # Save as single string
 
+    item['page_date'] = page_date(item.get('meta_date'))
+
     # Check for special properties
     item['blog_date'] = None
     item['blogged'] = False
@@ -304,9 +554,23 @@ def parse_path(systempath,db,commit=True,force=False):
             item['blog_date'] = time.mktime(date.timetuple())
             item['blogged'] = True
 
+    if metadata_only:
+        # Run the links through the same conversions as the HTML
+        html = ''.join('<a href="{}"></a>'.format(link) for link in utils.source_links(filetext))
+        html = utils.convert_relative_links(parts.rootname,html)
+        _,outgoing_links = utils.convert_internal_extension(html,
+                                extensions=NBCONFIG.extensions,return_links=True)
+
+        item['html'] = None
+        item['html_deferred'] = True
+        item['outgoing_links'] = ','.join(outgoing_links)
+        item['stext'] = utils.clean_for_search(utils.remove_source_links(filetext))
+        return item
+
     ## Process to HTML
     #item['md'] = filetext
     item['html'] = MD(filetext)
+    item['html_deferred'] = False
 
     # Make all relative links absolute (can be undone later)
     item['html'] = utils.convert_relative_links(parts.rootname,item['html'])
@@ -321,25 +585,237 @@ def parse_path(systempath,db,commit=True,force=False):
     item['outgoing_links'] = ','.join(outgoing_links)
     item['stext'] = utils.clean_for_search(item['html'])
 
-    # Either insert or update
+    return item
+
+def ensure_html(item,db):
+    """
+    Return item with its HTML rendered. Only needed for DB entries that did
+    not go through parse_path (e.g. from a query) since a metadata_only parse
+    defers the HTML
+    """
+    if item.get('html_deferred'):
+        return parse_path(item['systempath'],db)
+    return load_html(item,db)
 
-    item_list = [item.get(key[0],None) for key in SCHEMA]    # Items to be inserted
+def load_html(item,db):
+    """
+    Add the HTML from file_content to a file_db item if it does not have it
+    """
+    if 'html' not in item:
+        row = db.execute('SELECT html FROM file_content WHERE rootname=?',
+                         (item['rootname'],)).fetchone()
+        item['html'] = row['html'] if row is not None else None
+    return item
+
+# Another connection may have written the same new page first (rows wait in
+# its BatchWriter) so new rows that are already there are ignored and then
+# updated (see write_items). Not an UPSERT since that needs SQLite 3.24. The
+# rowid must be kept for search_fts and search_postings
+SQL_INSERT = 'INSERT OR IGNORE INTO file_db (' + ','.join(key[0] for key in SCHEMA) + ') ' \
+           + 'VALUES (' + ','.join('?' for _ in SCHEMA) + ')'
+SQL_UPDATE = 'UPDATE file_db SET ' + ','.join('{}=?'.format(key[0]) for key in SCHEMA) \
+                + ' WHERE rootname=?'
+
+def page_date(meta_date):
+    """Timestamp of the meta date (like blog_date) or None"""
+    date = utils.parse_date(meta_date or '')
+    if date is None:
+        return None
+    return time.mktime(date.timetuple())
+
+def page_tags(tags):
+    """Unique standard tags (utils.standard_tag) of the comma separated tags"""
+    return sorted(set(utils.standard_tag(tag) for tag in (tags or '').split(',') if tag.strip()))
+
+def link_edges(rootname,outgoing_links):
+    """
+    Return the file_links rows (source,target_rootbasename,target_id) for the
+    comma-joined outgoing_links of rootname. ID links only have a target_id
+    and the others only have a target_rootbasename
+    """
+    edges = set()
+    for link in (outgoing_links or '').split(','):
+        link = link.strip()
+        if link == '':
+            continue
+        if link.startswith('/_id/'):
+            edges.add((rootname,None,link[5:]))
+        else:
+            # Already through utils.convert_internal_extension
+            edges.add((rootname,os.path.splitext(link)[0],None))
+    return sorted(edges,key=lambda e:(e[1] or '',e[2] or ''))
+
+def write_items(items,db):
+    """
+    Write rendered items to the DB with executemany. items is a sequence of
+    (item,new) tuples. New items are inserted and others updated. The html
+    and stext go to file_content and file_search (and search_postings or,
+    if it is the search index in use, search_fts), the tags to file_tags,
+    and only the edges that changed are added to or removed from file_links
+    (so that only the affected crossref_cache entries are invalidated).
+
+    Does *not* commit
+    """
+    inserts,updates,contents,stexts,titles,tags = [],[],[],[],[],[]
+    new_items = []
+    fts = search.use_fts(db)
+    added,removed = [],[]
+    for item,new in items:
+        item_list = [item.get(key[0],None) for key in SCHEMA]    # Items to be inserted
+        if new:
+            inserts.append(item_list)
+            new_items.append(item)
+        else:
+            item_list.append(item['rootname'])
+            updates.append(item_list)
+        contents.append((item['rootname'],item.get('html',None)))
+        stexts.append((item['rootname'],item.get('stext',None)))
+        if fts:
+            titles.append(utils.clean_for_search(item.get('meta_title') or ''))
+        tags.extend((item['rootname'],tag) for tag in page_tags(item.get('tags')))
+
+        # Even new items may already have edges (see SQL_INSERT)
+        edges = set(link_edges(item['rootname'],item.get('outgoing_links')))
+        old = set((row['source'],row['target_rootbasename'],row['target_id'])
+                  for row in db.execute('SELECT * FROM file_links WHERE source=?',
+                                        (item['rootname'],)))
+        added.extend(edges - old)
+        removed.extend(old - edges)
 
     cursor = db.cursor()
-    if len(found) == 0: # new
-        qmarks = '(' + ','.join('?' for _ in item_list) + ')' # (?,?,...,?)
-        cursor.execute("""INSERT INTO file_db VALUES """ + qmarks,item_list)
-    else:
-        qmarks = ','.join('{}=?'.format(key[0]) for key in SCHEMA) # key1=?,key2=?,...
-        item_list.append(item['rootname'])
-        cursor.execute("""UPDATE file_db
-                          SET {qmarks}
-                          WHERE rootname=?""".format(qmarks=qmarks),item_list)
-    if commit:
-        db.commit()
+    if len(inserts) > 0:
+        cursor.executemany(SQL_INSERT,inserts)
+        if cursor.rowcount != len(inserts): # Some were already written
+            updates.extend(item_list + [item['rootname']]
+                           for item_list,item in zip(inserts,new_items))
+    if len(updates) > 0:
+        cursor.executemany(SQL_UPDATE,updates)
+    if len(contents) > 0:
+        cursor.executemany('INSERT OR REPLACE INTO file_content VALUES (?,?)',contents)
+        cursor.executemany('INSERT OR REPLACE INTO file_search VALUES (?,?)',stexts)
+        if fts:
+            # search_fts rows have the rowid of the file_db row
+            cursor.executemany('''DELETE FROM search_fts WHERE rowid =
+                                  (SELECT rowid FROM file_db WHERE rootname=?)''',
+                               [(rootname,) for rootname,_ in stexts])
+            cursor.executemany('''INSERT INTO search_fts(rowid,title,stext)
+                                  SELECT rowid,?,? FROM file_db WHERE rootname=?''',
+                               [(title,stext,rootname)
+                                for (rootname,stext),title in zip(stexts,titles)])
+        if search.has_postings(db):
+            write_postings([item for item,_ in items],db)
+        cursor.executemany('DELETE FROM file_tags WHERE rootname=?',
+                           [(rootname,) for rootname,_ in stexts])
+        cursor.executemany('INSERT INTO file_tags VALUES (?,?)',tags)
+    if len(removed) > 0:
+        cursor.executemany('''DELETE FROM file_links WHERE source=?
+                              AND target_rootbasename IS ? AND target_id IS ?''',removed)
+    if len(added) > 0:
+        cursor.executemany('INSERT INTO file_links VALUES (?,?,?)',added)
+    cursor.close()
+
+def write_postings(items,db):
+    """
+    Replace the search_postings rows of the (written) items. Does not commit
+    """
+    rows = []
+    for item in items:
+        doc = db.execute('SELECT rowid FROM file_db WHERE rootname=?',
+                         (item['rootname'],)).fetchone()['rowid']
+        db.execute('DELETE FROM search_postings WHERE doc=?',(doc,))
+        for term,positions in search.postings(item.get('meta_title'),item.get('stext')).items():
+            rows.append((term,doc,json.dumps(positions)))
+    db.executemany('INSERT INTO search_postings VALUES (?,?,?)',rows)
+
+class BatchWriter(object):
+    """
+    Collect the rows from parse_path (via add) and write them with
+    write_items when there are `batch_size` of them or the oldest is
+    `interval` seconds old. Rows for the same rootname are merged.
 
-    item['cached'] = False # Not in the DB but useful
-    return item
+    Every connection from db_conn has one (db.writer). The pending rows are
+    always written by db.commit() and db.close() and check_path looks at them
+    before the DB.
+
+    Options:
+        batch_size : [NBCONFIG.db_batch_size] Number of rows
+        interval   : [NBCONFIG.db_batch_interval] Seconds
+    """
+    def __init__(self,db,batch_size=None,interval=None):
+        self.db = db
+        self.batch_size = batch_size if batch_size is not None else NBCONFIG.db_batch_size
+        self.interval = interval if interval is not None else NBCONFIG.db_batch_interval
+        self.pending = OrderedDict() # rootname:(item,new)
+        self.t0 = None
+
+    def add(self,item,new,commit=True):
+        """
+        Add a rendered item. If the batch is full (or old), it is written and,
+        if commit, committed. Does nothing on a readonly connection
+        """
+        if self.db.readonly:
+            return
+        rootname = item['rootname']
+        if rootname in self.pending:
+            # Still not in the DB if it was new the first time
+            new = new or self.pending.pop(rootname)[1]
+        elif not self.pending:
+            self.t0 = time.time()
+        self.pending[rootname] = (item,new)
+
+        if len(self.pending) >= self.batch_size \
+                or time.time() - self.t0 >= self.interval:
+            self.flush(commit=commit)
+
+    def get(self,rootname):
+        """Return the pending item for rootname or None"""
+        return self.pending.get(rootname,(None,None))[0]
+
+    def flush(self,commit=True):
+        """
+        Write the pending rows (and commit). If writing fails, the rows are
+        dropped and the transaction is rolled back so the connection (and the
+        DB lock) is not left stuck before the error is raised
+        """
+        if self.pending:
+            try:
+                write_items(self.pending.values(),self.db)
+            except Exception:
+                self.pending.clear()
+                sqlite3.Connection.rollback(self.db)
+                raise
+            self.pending.clear()
+        if commit:
+            sqlite3.Connection.commit(self.db)
+
+class NBConnection(sqlite3.Connection):
+    """
+    sqlite3 connection with a BatchWriter so that rows from parse_path are
+    written in batches. Pending rows are written on commit() and close().
+
+    The connections from db_conn are pooled so close() only releases it
+    (pending rows are committed and anything else is rolled back)
+    """
+    readonly = False
+    pooled = False
+
+    def __init__(self,*args,**kwargs):
+        super(NBConnection,self).__init__(*args,**kwargs)
+        self.writer = BatchWriter(self)
+
+    def commit(self):
+        self.writer.flush(commit=True)
+
+    def close(self):
+        try:
+            if self.writer.pending:
+                self.writer.flush(commit=True)
+        finally:
+            # A pooled connection must never go back with an open transaction
+            if self.pooled:
+                self.rollback()
+        if not self.pooled:
+            super(NBConnection,self).close()
 
 
 ################### Web Helpers
@@ -357,12 +833,11 @@ def dir_listings(rootname,db,show_empty=False,drafts=False):
         if not systemdirname.endswith('/'):
             systemdirname = systemdirname + '/'
 
-        query = """SELECT * from file_db WHERE systempath LIKE ?"""
+        query = """SELECT 1 from file_db WHERE systempath LIKE ?"""
         if not drafts:
             query += ' AND draft=0'
 
-        sub = db.execute(query,(systemdirname + '%',)).fetchone()
-        return sub is not None and len(sub)>0
+        return db.execute(query,(systemdirname + '%',)).fetchone() is not None
 
     res = ['<p>{}</p>'.format(utils.all_sub_txt(rootname,strong=True))]
     res.append('<ul>')
@@ -382,9 +857,16 @@ def dir_listings(rootname,db,show_empty=False,drafts=False):
         if not isdir:
             if exclusion_check(get_rootname(sub_systempath)):
                 continue
-            fitem = parse_path(sub_systempath,db)
-            if fitem is None:
+            # Only the title and draft flag are needed. New or changed files
+            # are read in memory (not written) so browsing never leaves
+            # deferred rows. They are rendered in full when viewed
+            status,fitem = check_path(sub_systempath,db,metadata_only=True)
+            if status == 'skip':
                 continue
+            if status == 'touched':
+                db.commit()
+            if status in ['new','update']:
+                fitem = render_path(sub_systempath,metadata_only=True)
 
             if not drafts and fitem['draft']:
                 continue
@@ -444,11 +926,11 @@ def get_blog_page(num,db,drafts=False):
     # <= Npp, we're at the end! (ex: if there are Npp=8 and we only get <=8,
     # despite requesting >8, we are at the end)
     blog_list = db.execute("""
-        SELECT *
-        FROM file_db
+        SELECT file_db.*,file_content.html
+        FROM file_db LEFT JOIN file_content USING (rootname)
         WHERE blogged=1
         {draft_sql}
-        ORDER BY -blog_date
+        ORDER BY CAST(blog_date AS REAL) DESC
         LIMIT ?
         OFFSET ?""".format(draft_sql=draft_sql),(Npp+5,num*Npp)).fetchall()
 
@@ -459,8 +941,9 @@ def get_blog_page(num,db,drafts=False):
     # If there too many any deleted, it will show less than Npp per page.
     # (extreme edge case)
     blog_list = [item for item in blog_list if os.path.exists(item['systempath'])]
+    blog_list = [ensure_html(item,db) for item in blog_list[:Npp]]
 
-    return blog_list[:Npp],is_end
+    return blog_list,is_end
 
 def get_all_page(name,db,is_systemname=False,drafts=False):
     """
@@ -498,106 +981,151 @@ def get_all_page(name,db,is_systemname=False,drafts=False):
     # Finally, sort it (which will make it a list)
     return sorted(item_list,key=lambda a:a['rootname'].lower())
 
-def cross_ref(item,db):
+def resolve_links(edges,db,chunk=500):
+    """
+    Resolve the targets of file_links style edges (see link_edges) with one
+    query per `chunk` targets rather than one per link. Returns
+    {(target_rootbasename,target_id):page} where page has the rootbasename,
+    ref_name, draft and meta_id. ID links go to the first page with that ID.
+    Broken links are not in the result
+    """
+    names = sorted(set(edge[1] for edge in edges if edge[1] is not None))
+    ids = sorted(set(edge[2] for edge in edges if edge[2] is not None))
+
+    by_name,by_id = {},{}
+    for ii in range(0,max(len(names),len(ids)),chunk):
+        subnames,subids = names[ii:ii+chunk],ids[ii:ii+chunk]
+        sql = """SELECT rootbasename,ref_name,draft,meta_id
+                 FROM file_db
+                 WHERE rootbasename IN ({})
+                 OR meta_id IN ({})""".format(','.join('?' for _ in subnames),
+                                              ','.join('?' for _ in subids))
+        for page in db.execute(sql,subnames + subids):
+            by_name.setdefault(page['rootbasename'],page)
+            by_id.setdefault(page['meta_id'],page)
+
+    resolved = {}
+    for _,rootbasename,linkid in edges:
+        if linkid is not None:
+            page = by_id.get(linkid)
+        else:
+            page = by_name.get(rootbasename)
+        if page is not None:
+            resolved[rootbasename,linkid] = page
+    return resolved
+
+def cross_ref(item,db,drafts=False):
     """
-    Returns the cross ref html for a page
+    Returns the cross ref html for a page. Links to and from drafts are only
+    included if drafts. See cached_cross_ref
     """
     crossref = []
 
-    outgoing = set()
-    for link in item['outgoing_links'].split(','):
-        link = link.strip()
-        if link == '': 
+    # Outgoing links come from the item since it may not be written yet
+    edges = link_edges(item['rootname'],item['outgoing_links'])
+    resolved = resolve_links(edges,db)
+
+    outgoing = {} # rootbasename:match
+    for _,rootbasename,linkid in edges:
+        match = resolved.get((rootbasename,linkid))
+        if match is None: # Broken. See broken_links
             continue
-            
-        # ID links
-        if link.startswith('/_id/'):
-            linkid = link[5:]
-            # Get the first item with the ID. 
-            match = db.execute("""  SELECT rootbasename,draft 
-                                    FROM file_db 
-                                    WHERE meta_id=?""",(linkid,)).fetchone()
-            link = match['rootbasename'] + '.html'
-        else:
-            # Match without the extension since the text has already been
-            # through utils.convert_internal_extension 
-            match = db.execute("""
-                SELECT draft
-                FROM file_db
-                WHERE rootbasename=?""",(os.path.splitext(link)[0],)).fetchone()
-        
-        if match is None:
-            print('\nBroken link:\n to: {}\n in: {}'.format(link,item['rootbasename']))
+        if match['draft'] and not drafts: # == 1. If ==0, this will not flag
             continue
-        if match['draft']: # == 1. If ==0, this will not flag
-            logged_in,session = check_logged_in()
-            if not(session.get('name',None) in NBCONFIG.edit_users) or not session.get('valid',False):
-                continue
-                
-        outgoing.add(link)
-    
-    outgoing = sorted(outgoing,key=lambda a:a.lower())
+        outgoing[match['rootbasename']] = match
 
     if len(outgoing) > 0:
         crossref.append('<p>Outgoing:</p>\n<ul>')
-        for out in outgoing:
-            rootbasename = os.path.splitext(out)[0]
-            subitem = db.execute('SELECT rootbasename,ref_name FROM file_db WHERE rootbasename=?',(rootbasename,)).fetchone()
-            if subitem is None or len(subitem)==0:
-                print('\nBroken link:\n to: {}\n in: {}'.format(out,item['rootbasename']))
-                continue
-            crossref.append('<li><a href="{rootbasename}.html">{ref_name}</a></li>'.format(**subitem))
+        for out in sorted(outgoing,key=lambda a:a.lower()):
+            crossref.append('<li><a href="{rootbasename}.html">{ref_name}</a></li>'.format(**outgoing[out]))
         crossref.append('</ul>\n')
-    
-    # Query for all incoming links. All `outgoing_links` DB column are *full*
-    # paths. Note that the SQL query can be fooled since it is a 
-    # `LIKE %/link/to/me% query so anything starting with it will come up.
-    # We check for that later. If this current item does not have an ID, use
-    # some junk
-    idquery = item.get('meta_id')
-    if idquery is None or len(idquery) == 0:
-        idquery = utils.randstr(50)
-    else:
-        idquery = '/_id/' + idquery
-    
+
+    # Incoming links are the file_links edges to this rootbasename or ID
     incoming = db.execute("""
-            SELECT * FROM file_db 
-            WHERE outgoing_links LIKE ? 
-            OR outgoing_links LIKE ?
-            ORDER BY rootbasename""",
-            ('%' + item['rootbasename'] + '.%','%' + idquery + '%')).fetchall() 
-            
+            SELECT DISTINCT file_db.rootbasename,file_db.ref_name,file_db.draft
+            FROM file_links JOIN file_db ON file_db.rootname = file_links.source
+            WHERE file_links.target_rootbasename=?
+            OR file_links.target_id=?
+            ORDER BY file_db.rootbasename""",
+            (item['rootbasename'],item.get('meta_id') or None)).fetchall()
+
+    if not drafts:
+        incoming = [subitem for subitem in incoming if not subitem['draft']]
+
     if len(incoming) > 0:
-        icount = 0
         crossref.append('<p>Incoming:</p>\n<ul>')
         for subitem in incoming:
-            if subitem['draft']:
-                # Get login and session
-                logged_in,session = check_logged_in()
-                is_edit_user = session.get('name','') in NBCONFIG.edit_users
-                if not is_edit_user:
-                    continue
-            
-            # Make sure that it *actually* links to this page and not something 
-            # that starts the same (see note above)
-            subitem_outgoings = subitem['outgoing_links'].split(',')
-            for subitem_outgoing in subitem_outgoings:
-                if subitem_outgoing == idquery: # Compare ID
-                    break
-                # compare the base of the outgoing link to rootbasename
-                if os.path.splitext(subitem_outgoing)[0] == item['rootbasename']:
-                    break
-            else:
-                continue
             crossref.append('<li><a href="{rootbasename}.html">{ref_name}</a></li>'.format(**subitem))
-            icount += 1
-        
-        if icount == 0: 
-            del crossref[-1] # In case nothing was added after all
-        
         crossref.append('</ul>\n')
     return '\n'.join(crossref)
 
+def cached_cross_ref(item,db,drafts=False):
+    """
+    cross_ref with the html stored in crossref_cache by rootbasename and
+    drafts (i.e. edit user or not). Entries are removed by triggers when a
+    link to or from the page changes or a linked page is added, removed, or
+    changes its title, draft status, or ID. See _migrate_crossref_cache.
+
+    Pages that are not yet written (just rendered or still in the
+    BatchWriter) are not cached since their links are not in file_links
+    """
+    if db.readonly or not item.get('cached') \
+            or db.writer.get(item['rootname']) is not None:
+        return cross_ref(item,db,drafts=drafts)
+
+    key = (item['rootbasename'],int(bool(drafts)))
+    row = db.execute('''SELECT html FROM crossref_cache
+                        WHERE rootbasename=? AND drafts=?''',key).fetchone()
+    if row is not None:
+        return row['html']
+
+    html = cross_ref(item,db,drafts=drafts)
+    db.execute('INSERT OR REPLACE INTO crossref_cache VALUES (?,?,?)',key + (html,))
+    db.commit()
+    return html
+
+def index_generation(db):
+    """
+    Return the index generation. It is increased (by triggers) whenever pages
+    or links are added, removed, or changed so it can be used to invalidate
+    anything computed from the index
+    """
+    return db.execute('SELECT generation FROM index_generation').fetchone()['generation']
+
+_BROKEN_LINKS = {'generation':None,'links':[]}
+
+def broken_links(db):
+    """
+    Return a sorted list of (rootbasename,link) for every link in the DB
+    that does not go to a page. Computed in one query over file_links and
+    kept until the index_generation changes
+    """
+    generation = index_generation(db)
+    if _BROKEN_LINKS['generation'] == generation:
+        return _BROKEN_LINKS['links']
+
+    rows = db.execute("""
+        SELECT file_db.rootbasename,file_links.target_rootbasename,file_links.target_id
+        FROM file_links JOIN file_db ON file_db.rootname = file_links.source
+        WHERE (file_links.target_rootbasename IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM file_db AS target
+                WHERE target.rootbasename = file_links.target_rootbasename))
+        OR (file_links.target_id IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM file_db AS target
+                WHERE target.meta_id = file_links.target_id))""")
+
+    links = []
+    for row in rows:
+        if row['target_id'] is not None:
+            links.append((row['rootbasename'],'/_id/' + row['target_id']))
+        else:
+            links.append((row['rootbasename'],row['target_rootbasename'] + '.html'))
+    links.sort(key=lambda a:(a[0].lower(),a[1].lower()))
+
+    _BROKEN_LINKS['links'] = links
+    _BROKEN_LINKS['generation'] = generation
+    return links
+
 ################## Authentication web routes
 
 @route('/_login',method=['get','post'])
@@ -725,6 +1253,10 @@ def run_gc_thread():
 
 @route('/_refresh')
 def refresh(wait=''):
+    """
+    Start (or resume) the background reindex job and show its progress. Add
+    `?force=true` to reparse every file
+    """
     # Get login and session
     logged_in,session = check_logged_in()
     if not logged_in:
@@ -732,11 +1264,29 @@ def refresh(wait=''):
     elif session.get('name','') not in NBCONFIG.edit_users:
         abort(401)
 
-    yield "<p>Refreshing Index...</p>"
-    parse_all()
-    yield "<p>...Done</p>"
-    txt = utils.html_snippet('JS_forward.html')
-    yield txt.replace('DEST','/')
+    force = request.query.get('force','false').lower() == 'true'
+    indexer.REINDEX.start(force=force)
+
+    item = {'title':'Refreshing Index','html':utils.html_snippet('refresh_status.html')}
+    return fill_template(item,special=True)
+
+@route('/_refresh/status')
+def refresh_status():
+    """
+    JSON status of the reindex job: files done, remaining, and rate (files/s)
+    """
+    logged_in,session = check_logged_in()
+    if not logged_in:
+        redirect('/_login/_refresh')
+    elif session.get('name','') not in NBCONFIG.edit_users:
+        abort(401)
+
+    db = db_conn()
+    status = indexer.REINDEX.status(db)
+    db.close()
+
+    response.content_type = 'application/json'
+    return json.dumps(status)
 
 @route('/_bashcmd',method='POST')
 def bashcmd():
@@ -1015,7 +1565,9 @@ def edit_post(rootpath='/'):
         forward = utils.join('/',rootbasename + '.html')
     elif 'saveE' in request.POST:
         # Reparse the page in case it is never viewed
-        parse_path(systemname,db_conn(),commit=True,force=False)
+        db = db_conn()
+        parse_path(systemname,db,force=False,content=False)
+        db.close()
         forward = utils.join('/_edit/',rootbasename + '.html')
 
     ## Settings: get some of the settings and set the cookies with that value
@@ -1265,8 +1817,9 @@ def manage(rootpath=''):
             
             db = db_conn()
             if 'deletemedia' in request.POST:
-                html = db.execute("""SELECT html FROM file_db
-                                     WHERE rootname=?""",[path0]).fetchone()['html']
+                item = db.execute("""SELECT * FROM file_db
+                                     WHERE rootname=?""",[path0]).fetchone()
+                html = ensure_html(item,db)['html']
                 for medialink in utils.get_media_links(html,NBCONFIG.extensions):
                     fullpath = get_systemname(medialink)
                     if fullpath is not None:
@@ -1528,6 +2081,7 @@ def get_numeric_id():
                 break
         else: # I do not see how you could end up here...
             raise ValueError('Error in finding suitable id')    
+    db.close()
     return id0
             
     
@@ -1538,13 +2092,22 @@ def return_search():
     query = utils.to_unicode(query)
     
     loc = request.query.get('loc',default=None)
+    try:
+        page = int(request.query.get('page',default=1))
+    except ValueError:
+        page = 1
     
     content = "NBweb search engine results (beta)"
     
-    db = db_conn()
+    # Results are cached separately for edit users and everyone else
+    logged_in,session = check_logged_in()
+    is_edit_user = session.get('name','') in NBCONFIG.edit_users
+
+    db = db_conn(readonly=True)
 
     if len(query)>0:
-        results = search.search(query,db,loc=loc)
+        results = search.search(query,db,loc=loc,drafts=is_edit_user,
+                                generation=index_generation(db),page=page)
         content += '\n<hr></hr>\n' + results
     
     item = {'title': 'Search: "{}"'.format(query),'html':content}
@@ -1568,7 +2131,7 @@ def start_refresh(rootname='/'):
 @route('/_todo')
 @route('/_todo<loc:path>')
 def return_todo(loc=None):
-    db = db_conn()
+    db = db_conn(readonly=True)
     todo_text,todo_html = todo_tags.todos(db,loc=loc)
     item = {'title':'To Do Items','html':todo_html}
     db.close()
@@ -1577,7 +2140,7 @@ def return_todo(loc=None):
 @route('/_todotxt')
 @route('/_todotxt<loc:path>')
 def return_todo_txt(loc=None):
-    db = db_conn()
+    db = db_conn(readonly=True)
     todo_text,todo_html = todo_tags.todos(db,loc=loc)
     response.content_type = 'text/text; charset=UTF8' # Just raw text
     db.close()
@@ -1587,12 +2150,46 @@ def return_todo_txt(loc=None):
 @route('/_tags')
 @route('/_tags<loc:path>')
 def return_tags(loc=None):
-    db = db_conn()
+    db = db_conn(readonly=True)
     tags_html = todo_tags.tags(db,loc=loc)
     item = {'title':'All Tags','html':tags_html}
     db.close()
     return fill_template(item,special=True)
 
+@route('/_brokenlinks')
+def return_brokenlinks():
+    """
+    All of the links that do not go to a page
+    """
+    logged_in,session = check_logged_in()
+    if not logged_in:
+        redirect('/_login/_brokenlinks')
+    elif session.get('name','') not in NBCONFIG.edit_users:
+        abort(401)
+
+    db = db_conn(readonly=True)
+    links = broken_links(db)
+    db.close()
+
+    html = ['<p>{} broken links</p>'.format(len(links))]
+    if len(links) > 0:
+        html.append('<ul>')
+        for rootbasename,link in links:
+            html.append('<li><a href="{0}.html">{0}</a> &rarr; <code>{1}</code></li>'.format(
+                        rootbasename,utils.html_escape(link)))
+        html.append('</ul>')
+    item = {'title':'Broken Links','html':'\n'.join(html)}
+    return fill_template(item,special=True)
+
+def broken_links_txt():
+    """
+    The broken links as text. One `page.html -> link` per line
+    """
+    db = db_conn(readonly=True)
+    links = broken_links(db)
+    db.close()
+    return '\n'.join('{}.html -> {}'.format(*link) for link in links)
+
 @route('/_latest')
 @route('/_latest<rootpath:path>')
 def get_latest_rootname(rootpath='/'):
@@ -1750,9 +2347,9 @@ def rss():
     url = request.url[:-len('_rss')-1] # Make sure NOT to include the trailing /
     
     # Get the last 10 blogged pages
-    db = db_conn()
+    db = db_conn(readonly=True)
     pages,_ = get_blog_page(0,db,drafts=False)
-    
+    db.close()
     
     txt =  html_snippet('rss.rss',bottle_template={
                         'url':url,
@@ -1898,7 +2495,7 @@ def main_route(rootpath='/',map_view=False,blog_num=0):
             ).fetchall()
         html0 = ''
         if len(indexpage) == 1:
-            html0 = indexpage[0]['html'] + '\n\n'
+            html0 = ensure_html(indexpage[0],db)['html'] + '\n\n'
 
         item = dict()
 
@@ -1920,12 +2517,14 @@ def main_route(rootpath='/',map_view=False,blog_num=0):
         
         force = request.query.get('forcereload','false').lower() == 'true'
         item = parse_path(systemname,db,force=force)
+        indexer.record_view(parts.rootname)
 
         # drafts. Must be logged in as an edit_user
         if item['draft'] and not is_edit_user:
+            db.close()
             abort(401)
 
-        item['crossref'] = cross_ref(item,db)
+        item['crossref'] = cached_cross_ref(item,db,drafts=is_edit_user)
         
         db.close()
         return fill_template(item,show_path=True,refresh=refresh)
@@ -2267,28 +2866,469 @@ def log_to_logger(fn):
         return actual_response
     return _log_to_logger
 
-def db_conn():
-    db = sqlite3.connect(NBCONFIG.DBpath)
+# Per-thread connections. See db_conn
+_db_pool = threading.local()
+
+def db_conn(readonly=False):
+    """
+    Return this thread's DB connection. It is made on the first call and
+    then reused (NBConnection.close() just releases it).
+
+    Options:
+        readonly : [False] Return the read-only connection instead. Use for
+                   pure-read routes so they never block on (or take) the
+                   write lock. Pages parsed with it are returned but not
+                   written to the DB
+    """
+    key = 'readonly' if readonly else 'readwrite'
+    db = getattr(_db_pool,key,None)
+    if db is None:
+        db = new_db_conn(readonly=readonly)
+        db.pooled = True
+        setattr(_db_pool,key,db)
+    return db
+
+def new_db_conn(readonly=False):
+    """
+    Return a new (not pooled) NBConnection with the pragmas from NBCONFIG.
+    Read-only connections are opened with mode=ro if the sqlite3 module
+    supports URIs and are always set to query_only
+    """
+    if readonly:
+        try:
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(NBCONFIG.DBpath)))
+            db = sqlite3.connect(uri,uri=True,factory=NBConnection)
+        except TypeError: # Python 2 does not have uri
+            db = sqlite3.connect(NBCONFIG.DBpath,factory=NBConnection)
+        db.readonly = True
+        db.execute('PRAGMA query_only=1')
+    else:
+        db = sqlite3.connect(NBCONFIG.DBpath,factory=NBConnection)
+        if NBCONFIG.db_wal:
+            # Readers do not block the writer (and vice versa)
+            db.execute('PRAGMA journal_mode=WAL')
+
+    db.execute('PRAGMA synchronous={}'.format(NBCONFIG.db_synchronous))
+    db.execute('PRAGMA cache_size={:d}'.format(-int(NBCONFIG.db_cache_size)))
+    db.execute('PRAGMA mmap_size={:d}'.format(int(NBCONFIG.db_mmap_size)))
+
     db.text_factory = unicode
-    db.row_factory = utils.dict_factory
+    db.row_factory = utils.row_factory
     return db
 
 def init_db():
-    """ Setup the schema """
+    """
+    Setup (or upgrade) the schema by running the MIGRATIONS newer than the
+    version recorded in the schema_version table
+    """
     db = db_conn()
-    cursor = db.cursor()
+    db.execute("""CREATE TABLE IF NOT EXISTS schema_version(
+                    version int PRIMARY KEY,
+                    description text,
+                    applied text)""")
+    current = db.execute('SELECT MAX(version) AS version FROM schema_version').fetchone()['version'] or 0
+
+    for version,description,migrate in MIGRATIONS:
+        if version <= current:
+            continue
+        sys.stderr.write('Migrating DB to version {}: {}\n'.format(version,description))
+        migrate(db)
+        db.execute('INSERT INTO schema_version VALUES (?,?,?)',
+                   (version,description,datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        db.commit() # Each one is committed so an interrupted upgrade resumes
+    update_search_fts(db)
+    update_search_tokenizer(db)
+    db.close()
 
+def add_columns(db):
+    """
+    Add any columns in SCHEMA that are not in file_db (e.g. a DB from before
+    they were added). They are NULL until backfilled or the file is reparsed
+    """
+    columns = set(row['name'] for row in db.execute('PRAGMA table_info(file_db)'))
+    for name,sqltype in SCHEMA:
+        if name not in columns:
+            db.execute('ALTER TABLE file_db ADD COLUMN {} {}'.format(name,sqltype))
+
+def update_indexes(db):
+    """
+    Drop the file_db indexes no longer in INDEXES and make any new ones
+    """
+    add_columns(db) # In case an index is on a new column
+    names = set(name for name,_ in INDEXES)
+    for row in db.execute("""SELECT name FROM sqlite_master
+                             WHERE type='index' AND tbl_name='file_db'
+                             AND name LIKE 'idx\\_file\\_db\\_%' ESCAPE '\\'""").fetchall():
+        if row['name'] not in names:
+            db.execute('DROP INDEX IF EXISTS {}'.format(row['name']))
+    for name,columns in INDEXES:
+        db.execute('CREATE INDEX IF NOT EXISTS {} ON file_db({})'.format(name,columns))
+
+def mark_for_reparse(db,where='1',params=()):
+    """
+    Backfill for columns that can only come from the source: the matching
+    file_db rows (and the directory manifest) are invalidated so only those
+    files are reparsed on the next parse_all (or when viewed)
+    """
+    db.execute('UPDATE file_db SET mtime=NULL,content_hash=NULL WHERE ' + where,params)
+    db.execute('DELETE FROM dir_manifest')
+
+def _migrate_file_db(db):
     sql = """CREATE TABLE IF NOT EXISTS file_db("""
     sql += ','.join(' '.join(s) for s in SCHEMA) + ')'
+    db.execute(sql)
+    add_columns(db) # DBs from before schema versions
+
+def _migrate_split_content(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS file_content(
+                    rootname text PRIMARY KEY,
+                    html text)""")
+    db.execute("""CREATE TABLE IF NOT EXISTS file_search(
+                    rootname text PRIMARY KEY,
+                    stext text)""")
+
+    columns = set(row['name'] for row in db.execute('PRAGMA table_info(file_db)'))
+    if 'html' in columns:
+        # Move the content out and rebuild file_db without it. SQLite can only
+        # drop columns in newer versions
+        db.execute('INSERT OR REPLACE INTO file_content SELECT rootname,html FROM file_db')
+        db.execute('INSERT OR REPLACE INTO file_search SELECT rootname,stext FROM file_db')
+        add_columns(db)
+
+        names = ','.join(name for name,_ in SCHEMA)
+        db.execute('CREATE TABLE file_db_new(' + ','.join(' '.join(s) for s in SCHEMA) + ')')
+        db.execute('INSERT INTO file_db_new SELECT {} FROM file_db'.format(names))
+        db.execute('DROP TABLE file_db')
+        db.execute('ALTER TABLE file_db_new RENAME TO file_db')
+        update_indexes(db)
+
+    # Every place that deletes from file_db gets the content too
+    db.execute("""CREATE TRIGGER IF NOT EXISTS file_db_delete AFTER DELETE ON file_db
+                  BEGIN
+                    DELETE FROM file_content WHERE rootname=OLD.rootname;
+                    DELETE FROM file_search WHERE rootname=OLD.rootname;
+                  END""")
+
+def _migrate_link_graph(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS file_links(
+                    source text,
+                    target_rootbasename text,
+                    target_id text)""")
+    db.execute('CREATE INDEX IF NOT EXISTS idx_file_links_source ON file_links(source)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_file_links_target ON file_links(target_rootbasename)')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_file_links_id ON file_links(target_id)')
+
+    # Backfill from the stored outgoing_links
+    db.execute('DELETE FROM file_links')
+    rows = db.execute('SELECT rootname,outgoing_links FROM file_db').fetchall()
+    db.executemany('INSERT INTO file_links VALUES (?,?,?)',
+                   (edge for row in rows for edge in link_edges(row['rootname'],row['outgoing_links'])))
+
+    db.execute('DROP TRIGGER IF EXISTS file_db_delete')
+    db.execute("""CREATE TRIGGER file_db_delete AFTER DELETE ON file_db
+                  BEGIN
+                    DELETE FROM file_content WHERE rootname=OLD.rootname;
+                    DELETE FROM file_search WHERE rootname=OLD.rootname;
+                    DELETE FROM file_links WHERE source=OLD.rootname;
+                  END""")
+
+# rootbasenames of the pages that link to the {name} or {id} SQL expressions
+_SQL_LINKS_TO = """SELECT file_db.rootbasename
+                   FROM file_links JOIN file_db ON file_db.rootname = file_links.source
+                   WHERE file_links.target_rootbasename = {name}
+                   OR file_links.target_id = {id}"""
+
+def _migrate_crossref_cache(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS crossref_cache(
+                    rootbasename text,
+                    drafts int,
+                    html text,
+                    PRIMARY KEY (rootbasename,drafts))""")
+
+    # A page's cross ref changes when an edge from or to it is added or
+    # removed or when a page it links to (or that links to it) is added,
+    # removed, or changes its title, draft status, or ID
+    for action,row in [('INSERT','NEW'),('DELETE','OLD')]:
+        db.execute("""CREATE TRIGGER IF NOT EXISTS crossref_links_{name}
+                      AFTER {action} ON file_links
+                      BEGIN
+                        DELETE FROM crossref_cache
+                        WHERE rootbasename = {row}.target_rootbasename
+                        OR rootbasename IN (SELECT rootbasename FROM file_db
+                                            WHERE rootname = {row}.source
+                                            OR meta_id = {row}.target_id);
+                      END""".format(name=action.lower(),action=action,row=row))
+
+        db.execute("""CREATE TRIGGER IF NOT EXISTS crossref_file_db_{name}
+                      AFTER {action} ON file_db
+                      BEGIN
+                        DELETE FROM crossref_cache
+                        WHERE rootbasename = {row}.rootbasename
+                        OR rootbasename IN ({links_to});
+                      END""".format(name=action.lower(),action=action,row=row,
+                                     links_to=_SQL_LINKS_TO.format(name=row + '.rootbasename',
+                                                                   id=row + '.meta_id')))
+
+    db.execute("""CREATE TRIGGER IF NOT EXISTS crossref_file_db_update
+                  AFTER UPDATE OF rootbasename,ref_name,draft,meta_id ON file_db
+                  WHEN OLD.rootbasename IS NOT NEW.rootbasename
+                  OR OLD.ref_name IS NOT NEW.ref_name
+                  OR OLD.draft IS NOT NEW.draft
+                  OR OLD.meta_id IS NOT NEW.meta_id
+                  BEGIN
+                    DELETE FROM crossref_cache
+                    WHERE rootbasename IN (OLD.rootbasename,NEW.rootbasename)
+                    OR rootbasename IN ({old_links_to})
+                    OR rootbasename IN ({new_links_to})
+                    OR rootbasename IN (SELECT target_rootbasename FROM file_links
+                                        WHERE source = NEW.rootname)
+                    OR rootbasename IN (SELECT file_db.rootbasename
+                                        FROM file_links JOIN file_db
+                                        ON file_db.meta_id = file_links.target_id
+                                        WHERE file_links.source = NEW.rootname);
+                  END""".format(
+                    old_links_to=_SQL_LINKS_TO.format(name='OLD.rootbasename',id='OLD.meta_id'),
+                    new_links_to=_SQL_LINKS_TO.format(name='NEW.rootbasename',id='NEW.meta_id')))
+
+def _migrate_index_generation(db):
+    db.execute('CREATE TABLE IF NOT EXISTS index_generation(generation int)')
+    if db.execute('SELECT COUNT(*) AS N FROM index_generation').fetchone()['N'] == 0:
+        db.execute('INSERT INTO index_generation VALUES (0)')
+
+    for table in ['file_db','file_links']:
+        for action in ['INSERT','UPDATE','DELETE']:
+            if table == 'file_links' and action == 'UPDATE':
+                continue # Edges are only inserted and deleted
+            db.execute("""CREATE TRIGGER IF NOT EXISTS generation_{table}_{name}
+                          AFTER {action} ON {table}
+                          BEGIN
+                            UPDATE index_generation SET generation = generation + 1;
+                          END""".format(table=table,name=action.lower(),action=action))
+
+def _migrate_search_fts(db):
+    try:
+        db.execute("""CREATE VIRTUAL TABLE IF NOT EXISTS search_fts
+                      USING fts5(title,stext)""")
+    except sqlite3.OperationalError: # No FTS5. search uses the LIKE scan
+        sys.stderr.write('SQLite FTS5 is not available. Using the legacy search\n')
+        return
+
+    db.execute('DELETE FROM search_fts')
+    db.execute("""INSERT INTO search_fts(rowid,title,stext)
+                  SELECT file_db.rowid,file_db.meta_title,file_search.stext
+                  FROM file_db JOIN file_search USING (rootname)""")
+    db.execute("""CREATE TRIGGER IF NOT EXISTS search_fts_delete AFTER DELETE ON file_db
+                  BEGIN
+                    DELETE FROM search_fts WHERE rowid = OLD.rowid;
+                  END""")
+
+def _migrate_search_postings(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS search_postings(
+                    term text,
+                    doc int,
+                    positions text,
+                    PRIMARY KEY (term,doc)) WITHOUT ROWID""")
+    db.execute('CREATE INDEX IF NOT EXISTS idx_search_postings_doc ON search_postings(doc)')
+
+    db.execute('DELETE FROM search_postings')
+    rows = db.execute("""SELECT file_db.rootname,file_db.meta_title,file_search.stext
+                         FROM file_db JOIN file_search USING (rootname)""").fetchall()
+    for ii in range(0,len(rows),200):
+        write_postings(rows[ii:ii+200],db)
+
+    db.execute("""CREATE TRIGGER IF NOT EXISTS search_postings_delete AFTER DELETE ON file_db
+                  BEGIN
+                    DELETE FROM search_postings WHERE doc = OLD.rowid;
+                  END""")
+
+def _migrate_authority(db):
+    db.execute("""CREATE TABLE IF NOT EXISTS page_authority(
+                    rootbasename text PRIMARY KEY,
+                    authority real)""")
+    db.execute('CREATE TABLE IF NOT EXISTS authority_state(stale int)')
+    db.execute('DELETE FROM authority_state')
+    db.execute('INSERT INTO authority_state VALUES (1)')
+
+    # Any change to the pages or links makes the authorities stale
+    for table,action in [('file_links','INSERT'),('file_links','DELETE'),
+                         ('file_db','INSERT'),('file_db','DELETE')]:
+        db.execute("""CREATE TRIGGER IF NOT EXISTS authority_{table}_{name}
+                      AFTER {action} ON {table}
+                      BEGIN
+                        UPDATE authority_state SET stale=1;
+                      END""".format(table=table,name=action.lower(),action=action))
+    db.execute("""CREATE TRIGGER IF NOT EXISTS authority_file_db_update
+                  AFTER UPDATE OF rootbasename,meta_id ON file_db
+                  BEGIN
+                    UPDATE authority_state SET stale=1;
+                  END""")
+
+    search.update_authority(db)
+
+def search_tokenizer():
+    """
+    Name of the utils.search_tokens settings the index is built with. Change
+    the name when utils.stem changes (e.g. 'stem2' strips -es after s, x, z,
+    ch, and sh) so the index is rebuilt with it
+    """
+    return 'stem2' if NBCONFIG.search_stem else 'plain'
 
-    cursor.execute(sql)
+def update_search_tokenizer(db):
+    """
+    If the search tokenizer settings changed since the index was built, bring
+    the index in line with the queries again. Stemming works word by word on
+    the stored (cleaned) stext so turning it on restems the index in place.
+    Turning it off (or changing the stemmer) needs the source so every page
+    is marked to be reparsed
+    """
+    row = db.execute('SELECT tokenizer FROM search_tokenizer').fetchone()
+    if row['tokenizer'] == search_tokenizer():
+        return
+    if NBCONFIG.search_stem and row['tokenizer'] == 'plain':
+        sys.stderr.write('Search tokenizer changed to "{}". Restemming the search index\n'.format(search_tokenizer()))
+        rows = db.execute('SELECT rootname,stext FROM file_search').fetchall()
+        db.executemany('UPDATE file_search SET stext=? WHERE rootname=?',
+                       [(' '.join(utils.stem(word) for word in (row['stext'] or '').split()),
+                         row['rootname']) for row in rows])
+        rebuild_search_index(db)
+    else:
+        sys.stderr.write('Search tokenizer changed to "{}". Pages will be reindexed\n'.format(search_tokenizer()))
+        mark_for_reparse(db)
+    db.execute('UPDATE search_tokenizer SET tokenizer=?',(search_tokenizer(),))
     db.commit()
 
-#     cursor.execute("""\
-#         CREATE UNIQUE INDEX IF NOT EXISTS
-#         indx_rootname ON file_db (rootname)""")
-#     db.commit()
-    db.close()
+def rebuild_search_index(db):
+    """
+    Rebuild search_postings and (if in use) search_fts from the titles and
+    file_search. Does not commit
+    """
+    if search.use_fts(db):
+        rebuild_search_fts(db)
+    rows = db.execute("""SELECT file_db.rootname,file_db.meta_title,file_search.stext
+                         FROM file_db JOIN file_search USING (rootname)""").fetchall()
+    if search.has_postings(db):
+        db.execute('DELETE FROM search_postings')
+        for ii in range(0,len(rows),200):
+            write_postings(rows[ii:ii+200],db)
+
+def rebuild_search_fts(db):
+    """Refill search_fts from the titles and file_search. Does not commit"""
+    rows = db.execute("""SELECT file_db.rowid,file_db.meta_title,file_search.stext
+                         FROM file_db JOIN file_search USING (rootname)""").fetchall()
+    db.execute('DELETE FROM search_fts')
+    db.executemany('INSERT INTO search_fts(rowid,title,stext) VALUES (?,?,?)',
+                   [(row['rowid'],utils.clean_for_search(row['meta_title'] or ''),row['stext'])
+                    for row in rows])
+
+def update_search_fts(db):
+    """
+    search_fts is only written while it is the search index in use
+    (search.use_fts). Fill it when it becomes the one in use and empty it
+    (rather than keep a third copy of the search text) when it stops
+    """
+    if not search.has_fts(db):
+        return
+    built = bool(db.execute('SELECT built FROM search_fts_state').fetchone()['built'])
+    if built == search.use_fts(db):
+        return
+    if built:
+        db.execute('DELETE FROM search_fts')
+    else:
+        sys.stderr.write('Building the search_fts index\n')
+        rebuild_search_fts(db)
+    db.execute('UPDATE search_fts_state SET built=?',(int(not built),))
+    db.commit()
+
+def _migrate_search_tokenizer(db):
+    # Any index so far is from the unstemmed tokenizer. See update_search_tokenizer
+    tokenizer = 'plain'
+    if db.execute('SELECT 1 FROM file_db LIMIT 1').fetchone() is None:
+        tokenizer = search_tokenizer() # Nothing to reindex
+    db.execute('CREATE TABLE IF NOT EXISTS search_tokenizer(tokenizer text)')
+    db.execute('DELETE FROM search_tokenizer')
+    db.execute('INSERT INTO search_tokenizer VALUES (?)',(tokenizer,))
+
+    # search_fts titles are now tokenized the same as the stext
+    if search.has_fts(db):
+        rows = db.execute('SELECT rowid,meta_title FROM file_db').fetchall()
+        db.executemany('UPDATE search_fts SET title=? WHERE rowid=?',
+                       [(utils.clean_for_search(row['meta_title'] or '',stem_words=False),row['rowid'])
+                        for row in rows])
+
+def _migrate_search_filters(db):
+    # page_date for date: filters
+    add_columns(db)
+    rows = db.execute('SELECT rootname,meta_date FROM file_db').fetchall()
+    db.executemany('UPDATE file_db SET page_date=? WHERE rootname=?',
+                   [(page_date(row['meta_date']),row['rootname']) for row in rows])
+    update_indexes(db)
+
+    # file_tags for tag: filters
+    db.execute("""CREATE TABLE IF NOT EXISTS file_tags(
+                    rootname text,
+                    tag text,
+                    PRIMARY KEY (tag,rootname)) WITHOUT ROWID""")
+    db.execute('CREATE INDEX IF NOT EXISTS idx_file_tags_rootname ON file_tags(rootname)')
+    db.execute('DELETE FROM file_tags')
+    rows = db.execute('SELECT rootname,tags FROM file_db').fetchall()
+    db.executemany('INSERT INTO file_tags VALUES (?,?)',
+                   ((row['rootname'],tag) for row in rows for tag in page_tags(row['tags'])))
+    db.execute("""CREATE TRIGGER IF NOT EXISTS file_tags_delete AFTER DELETE ON file_db
+                  BEGIN
+                    DELETE FROM file_tags WHERE rootname=OLD.rootname;
+                  END""")
+
+def _migrate_authority_trigger(db):
+    # write_items UPDATEs set every column so only fire on actual changes
+    db.execute('DROP TRIGGER IF EXISTS authority_file_db_update')
+    db.execute("""CREATE TRIGGER authority_file_db_update
+                  AFTER UPDATE OF rootbasename,meta_id ON file_db
+                  WHEN OLD.rootbasename IS NOT NEW.rootbasename
+                  OR OLD.meta_id IS NOT NEW.meta_id
+                  BEGIN
+                    UPDATE authority_state SET stale=1;
+                  END""")
+
+def _migrate_search_fts_state(db):
+    # Whether search_fts is filled. See update_search_fts
+    db.execute('CREATE TABLE IF NOT EXISTS search_fts_state(built int)')
+    db.execute('DELETE FROM search_fts_state')
+    db.execute('INSERT INTO search_fts_state VALUES (?)',(int(search.has_fts(db)),))
+
+def _migrate_aux_tables(db):
+    # Directory listings and mtimes from the last parse_all. See walk_source
+    db.execute("""CREATE TABLE IF NOT EXISTS dir_manifest(
+                    rootdirname text PRIMARY KEY,
+                    mtime real,
+                    dirnames text,
+                    files text)""")
+
+    # Checkpointed queue of the background reindex. See indexer.ReindexJob
+    db.execute("""CREATE TABLE IF NOT EXISTS reindex_queue(
+                    rootname text PRIMARY KEY,
+                    systempath text,
+                    priority int,
+                    done int)""")
+
+# Ordered (version,description,function) steps run by init_db. Never edit or
+# remove a step that has shipped; append a new one. Steps should be safe to
+# rerun (IF NOT EXISTS, add_columns, etc) since DDL may not be rolled back.
+# To add a column: append it to SCHEMA and add a step that calls add_columns
+# then backfills it with an UPDATE or, if it needs the source, mark_for_reparse
+MIGRATIONS = [(1,'file_db table',_migrate_file_db),
+              (2,'dir_manifest and reindex_queue tables',_migrate_aux_tables),
+              (3,'file_db indexes',update_indexes),
+              (4,'html and stext in file_content and file_search',_migrate_split_content),
+              (5,'file_links link graph',_migrate_link_graph),
+              (6,'crossref_cache and its triggers',_migrate_crossref_cache),
+              (7,'index_generation and its triggers',_migrate_index_generation),
+              (8,'search_fts full-text index',_migrate_search_fts),
+              (9,'search_postings positional index',_migrate_search_postings),
+              (10,'page_authority link scores',_migrate_authority),
+              (11,'search_tokenizer and cleaned search_fts titles',_migrate_search_tokenizer),
+              (12,'page_date and file_tags for search filters',_migrate_search_filters),
+              (13,'authority_file_db_update only on changes',_migrate_authority_trigger),
+              (14,'search_fts_state',_migrate_search_fts_state)]
 
 def navwrapper(callback):
     """
@@ -2322,7 +3362,15 @@ def navwrapper(callback):
         return body
     return wrapper
     
-def start(garbage_collect=True):
+def start(garbage_collect=True,watch=None):
+    """
+    Start the server.
+
+    Options:
+        garbage_collect : [True] Run the garbage collection thread
+        watch           : [None] Run the source watcher thread that updates the
+                          DB as files change. None uses NBCONFIG.watch_source
+    """
     global app
     if garbage_collect:
         th = Thread(target=run_gc_thread)
@@ -2334,6 +3382,19 @@ def start(garbage_collect=True):
     app.install(navwrapper)
     init_db()
 
+    if watch is None:
+        watch = NBCONFIG.watch_source
+    if watch:
+        indexer.SourceWatcher(interval=NBCONFIG.watch_interval,
+                              poll_interval=NBCONFIG.watch_poll_interval,
+                              authority_interval=NBCONFIG.watch_authority_interval).start()
+
+    # Resume a reindex that was killed
+    db = db_conn()
+    if indexer.REINDEX.pending(db):
+        indexer.REINDEX.start()
+    db.close()
+
     app.run(**NBCONFIG.web_server)
 
 
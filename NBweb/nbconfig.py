@@ -53,6 +53,8 @@ class ConfigParser:
             setattr(self,key,val)
         
         self._set_values()
+        self.filename = filename
+        self._parsed = True
         
     def _set_values(self):    
         self.extensions = [a.lower() for a in self.extensions]
@@ -2,16 +2,33 @@
 from __future__ import division,print_function,unicode_literals,absolute_import
 import json
 import os
+import sys
 import io
+import re
+import time
+from datetime import datetime,timedelta
 import itertools
-from collections import defaultdict
+import heapq
+import threading
+from collections import defaultdict,OrderedDict
 
 from sqlite3 import OperationalError
 
 # import utils
 from . import utils
+from .nbconfig import NBCONFIG
 join = utils.join
 
+# Python Compatability
+if sys.version_info[0] >= 3:
+    from urllib.parse import urlencode
+else:
+    from urllib import urlencode
+try:
+    unicode
+except NameError: # Python 3
+    unicode = str
+
 """
 Algorthithm and scoring as of 2017-03-19
 Example: "Costco's rottisserie chicken salad"
@@ -43,6 +60,31 @@ Example: "Costco's rottisserie chicken salad"
     direct + 1/3 * sqrt(link)  if direct >0
     3.41 + 0.333 * sqrt(8.436) == 4.377
 
+Queries can also have (see parse_query):
+    "exact phrase"      The words must be in the page in a row
+    -word, -"a phrase"  Pages with the word (all of the phrase's words) are left out
+    title:word          The word must be in the title. Also title:"a b"
+    tag:name            Pages with the tag
+    path:dir/sub        Pages in the directory or below
+    date:>2019          Pages with a (meta) date after 2019. Also <, >=, <=, and
+                        2019, 2019-05, or 2019-05-20 alone for in that period
+    draft:yes           Drafts only (or draft:no). Only edit users see drafts
+Any of the filters can be negated with `-`. Filters and the required and
+excluded words are compiled to SQL predicates on indexed columns (see
+compile_query) so a restrictive query only reads the pages that can match.
+Only the plain, phrase, and title: words are scored.
+
+With `search_authority`, the link score is instead from the PageRank style
+authority of the page over the *whole* link graph (see update_authority)
+rather than from the links among the results. It is authority_mult_fcn of
+the direct score and the authority (scaled so the average page is 1).
+
+Only the top results (through the requested page) are kept, in a heap. With
+the positional index and `search_authority`, each page also gets a cheap
+upper bound on its score (a window can't appear more often than its rarest
+word) and pages are scored best bound first, stopping once no remaining page
+could make it into the heap. This assumes wind_mult_fcn, authority_mult_fcn
+and combine_score don't decrease with the counts.
 
 """
 
@@ -50,6 +92,7 @@ Example: "Costco's rottisserie chicken salad"
 # Weights and manipulations
 wind_mult_fcn = lambda n: root(n,2)
 link_mult_fcn = lambda n: root(n,4) # ^1/4 root. More linked pages means better results
+authority_mult_fcn = lambda direct,authority: direct*authority
 def combine_score(direct,link):
     if direct == 0:
         return 0.0
@@ -58,18 +101,102 @@ def combine_score(direct,link):
 # Format
 FMT =  '<p><a href="{path}.html">{name}</a>'
 FMT += '<br>{path} <small>({score:0.2f})</small></p>'
+PAGE_FMT = '<p>{prev} Page {page} {next}</p>'
 
-def search(query,db,loc=None):
-    incoming_count = defaultdict(lambda: {'count':0,'score':0}) 
-    
-    Nmax = 4 # largest window (plus the original)
+# Rendered results of recent searches (most recent last) by
+# (cleaned query,loc,drafts):(index_generation,results). See search
+SEARCH_CACHE = OrderedDict()
+SEARCH_CACHE_MAX = 256
+_search_cache_lock = threading.Lock()
 
-    # Remove stop words etc:
-    query0 = query
-    query = utils.clean_for_search(query)
+def search(query,db,loc=None,drafts=False,generation=None,page=1):
+    """
+    Return the HTML of the search results on page (starting at 1, with
+    NBCONFIG.search_per_page results each) with links to the other pages.
+
+    If generation (the index_generation of the DB) is given, results are
+    cached and only reused while the generation is the same, i.e. until
+    anything in the index changes
+    """
+    try:
+        parsed = parse_query(query)
+    except ValueError as E:
+        return 'Error: {}'.format(E)
     
-    if len(query.split()) == 0:
-        return 'Error: Non-sufficient search query: "{}"'.format(query0)
+    if len(parsed['words']) == 0 and len(parsed['filters']) == 0:
+        return 'Error: Non-sufficient search query: "{}"'.format(query)
+
+    page = max(1,page)
+
+    if generation is None:
+        out,more = search_results(parsed,db,loc=loc,drafts=drafts,page=page)
+    else:
+        key = (' '.join(query.split()),loc,bool(drafts),page)
+        with _search_cache_lock:
+            cached = SEARCH_CACHE.pop(key,None)
+            if cached is not None and cached[0] == generation:
+                SEARCH_CACHE[key] = cached # Now most recent
+        if cached is not None and cached[0] == generation:
+            out,more = cached[1]
+        else:
+            out,more = search_results(parsed,db,loc=loc,drafts=drafts,page=page)
+            with _search_cache_lock:
+                SEARCH_CACHE[key] = (generation,(out,more))
+                while len(SEARCH_CACHE) > SEARCH_CACHE_MAX:
+                    SEARCH_CACHE.popitem(last=False)
+
+    if len(out) == 0 and page == 1:
+        return 'No results for "{}"'.format(query)
+
+    if page > 1 or more:
+        prev = next = ''
+        if page > 1:
+            prev = '<a href="{}">&larr; Previous</a>'.format(page_link(query,loc,page-1))
+        if more:
+            next = '<a href="{}">Next &rarr;</a>'.format(page_link(query,loc,page+1))
+        out = out + [PAGE_FMT.format(prev=prev,page=page,next=next)]
+
+    return '\n'.join(out)
+
+def page_link(query,loc,page):
+    """/_search URL of page of the (uncleaned) query"""
+    params = [('q',query)]
+    if loc:
+        params.append(('loc',loc))
+    params.append(('page',page))
+    if sys.version_info[0] < 3:
+        params = [(k,v.encode('utf8') if isinstance(v,unicode) else v) for k,v in params]
+    return '/_search?' + urlencode(params)
+
+def search_results(parsed,db,loc=None,drafts=True,page=1):
+    """
+    Return (results,more) for the parse_query query where results are the
+    rendered (FMT) results on page and more is whether there are any after it
+    """
+    per_page = NBCONFIG.search_per_page
+    k = page*per_page + 1 # One extra to tell if there is a next page
+
+    if NBCONFIG.search_postings and has_postings(db):
+        backend = 'postings'
+    elif use_fts(db):
+        backend = 'fts'
+    else:
+        backend = 'like'
+    where,params = compile_query(parsed,backend,loc=loc,drafts=drafts)
+    keep = lambda title,doc_postings: query_matches(parsed,title,doc_postings)
+
+    query = ' '.join(parsed['words'])
+    if len(query) == 0: # Only filters. Every page is scored the same
+        scored = ((row['rootbasename'],row['meta_title'],1.0,row['outgoing_links'])
+                  for row in candidates_filtered(db,where,params)
+                  if keep(row['meta_title'],{}))
+        if NBCONFIG.search_authority:
+            top = top_authority(scored,db,k)
+        else:
+            top = top_linked(scored,k)
+        return render_top(top,page,per_page)
+
+    Nmax = 4 # largest window (plus the original)
 
     # In this algorithm, order does matter to increase score. But, we limit the search
     query_windows = set(' '.join(wind) for wind in all_window(query.split(),Nmax=Nmax) )
@@ -80,8 +207,312 @@ def search(query,db,loc=None):
     # Make it a list with the multiplier (sqrt(N))
     query_windows = [(window,wind_mult_fcn(len(window.split())) ) for window in query_windows]
 
-    page_scores_direct = {}
+    if backend == 'postings':
+        docs = [doc for doc in read_postings(query.split(),db,where,params)
+                if keep(doc[1],doc[3])]
+        if NBCONFIG.search_authority:
+            top = top_postings(docs,query_windows,db,k)
+        else:
+            top = top_linked(score_postings(docs,query_windows),k)
+    else:
+        if backend == 'fts':
+            pages = candidates_fts(query.split(),db,where,params)
+        else:
+            pages = candidates_like(query.split(),db,where,params)
+        scored = score_pages(pages,query_windows,keep=keep)
+        if NBCONFIG.search_authority:
+            top = top_authority(scored,db,k)
+        else:
+            top = top_linked(scored,k)
+
+    return render_top(top,page,per_page)
+
+def render_top(top,page,per_page):
+    """
+    Return (results,more) of the top (score,direct,rootbasename,meta_title)
+    heap like search_results
+    """
+    top.sort(reverse=True) # Sort by overall score then direct score
+
+    out = []
+    for score,direct,path,name in top[(page-1)*per_page:page*per_page]:
+        out.append(FMT.format(path=path,name=name,score=score))
 
+    return out,len(top) > page*per_page
+
+def push_top(heap,k,item):
+    """
+    Keep the top k items in the min-heap. Items are
+    (score,direct,rootbasename,meta_title)
+    """
+    if item[0] == 0:
+        return
+    if len(heap) < k:
+        heapq.heappush(heap,item)
+    elif item > heap[0]:
+        heapq.heapreplace(heap,item)
+
+def authority_score(direct,authority):
+    """Overall score from the direct score and the authority"""
+    return combine_score(direct,authority_mult_fcn(direct,authority))
+
+def top_authority(scored,db,k):
+    """
+    Top k (score,direct,rootbasename,meta_title) of the scored pages with
+    the search_authority boost
+    """
+    scored = list(scored)
+    authority = get_authority([name for name,_,_,_ in scored],db)
+    heap = []
+    for name,title,direct,_ in scored:
+        score = authority_score(direct,authority.get(name,1.0))
+        push_top(heap,k,(score,direct,name,title))
+    return heap
+
+def top_linked(scored,k):
+    """
+    Top k (score,direct,rootbasename,meta_title) of the scored pages with
+    the old boost from the links among the results. Every page has to be
+    scored first
+    """
+    incoming_count = defaultdict(lambda: {'count':0,'score':0})
+    pages = []
+    for name,title,direct,outgoing_links in scored:
+        pages.append((name,title,direct))
+
+        # Add this score to each outgoing link
+        outs = [os.path.splitext(it)[0] for it in outgoing_links.split(',')]
+        for out in outs:
+            incoming_count[out]['count'] += 1
+            incoming_count[out]['score'] += direct
+
+    heap = []
+    for name,title,direct in pages:
+        incoming = link_mult_fcn(incoming_count[name]['count']) * incoming_count[name]['score']
+        push_top(heap,k,(combine_score(direct,incoming),direct,name,title))
+    return heap
+
+def top_postings(docs,query_windows,db,k):
+    """
+    Top k (score,direct,rootbasename,meta_title) of the read_postings docs
+    with the search_authority boost. Pages are scored in order of their
+    upper bound and the rest are skipped once none can make the top k
+    """
+    query_windows = [(window.split(),mult) for window,mult in query_windows]
+    authority = get_authority([doc[0] for doc in docs],db)
+
+    bounded = []
+    for doc in docs:
+        # A window can't be in the page more times than its rarest word
+        direct = 0
+        for window,mult in query_windows:
+            count = min(len(doc[3].get(word,())) for word in window)
+            direct += root(count,3) * mult
+        auth = authority.get(doc[0],1.0)
+        bounded.append((authority_score(direct,auth),direct,auth,doc))
+    bounded.sort(key=lambda b:b[:2],reverse=True)
+
+    heap = []
+    for bound,bound_direct,auth,(name,title,_,doc_postings) in bounded:
+        if len(heap) == k and (bound,bound_direct) < heap[0][:2]:
+            break
+        direct = 0
+        for window,mult in query_windows:
+            direct += root(window_count(window,doc_postings),3) * mult
+        push_top(heap,k,(authority_score(direct,auth),direct,name,title))
+    return heap
+
+def score_pages(pages,query_windows,keep=None):
+    """
+    Yield (rootbasename,meta_title,score,outgoing_links) for candidate pages
+    by counting every window in the title (twice) and stext. Windows match
+    whole words only (the same as score_postings).
+
+    Options:
+        keep : [None] Function of (meta_title,postings) that is False for
+               pages to skip (e.g. query_matches)
+    """
+    query_windows = [(window.split(),mult) for window,mult in query_windows]
+    for page in pages:
+        # Scores are based on the length of the match. But do recall that
+        # matching 'A B' means you also matches 'A' and 'B'
+        doc_postings = postings(page['meta_title'],page['stext'])
+        if keep is not None and not keep(page['meta_title'],doc_postings):
+            continue
+        score = 0
+        for window,mult in query_windows:
+            score += root(window_count(window,doc_postings),3) * mult
+
+        yield page['rootbasename'],page['meta_title'],score,page['outgoing_links']
+
+def has_postings(db):
+    """Whether the DB has the search_postings (positional index) table"""
+    return db.execute("""SELECT 1 FROM sqlite_master
+                         WHERE type='table' AND name='search_postings'""").fetchone() is not None
+
+def postings(title,stext):
+    """
+    Return the positional postings {term:[positions]} of a page. The text is
+    the same as scored by score_pages: the title (cleaned) twice then the
+    stext
+    """
+    title = list(utils.search_tokens(title or ''))
+    terms = itertools.chain(title,title,(stext or '').split())
+    out = defaultdict(list)
+    for position,term in enumerate(terms):
+        out[term].append(position)
+    return out
+
+def window_count(words,doc_postings):
+    """
+    Number of times the words appear in a row given the postings
+    {term:[positions]} of one page
+    """
+    positions = None
+    for offset,word in enumerate(words):
+        word_positions = doc_postings.get(word)
+        if not word_positions:
+            return 0
+        if positions is None:
+            positions = set(word_positions)
+        else:
+            positions.intersection_update(p - offset for p in word_positions)
+        if not positions:
+            return 0
+    return len(positions)
+
+def read_postings(words,db,where=None,params=()):
+    """
+    Return [(rootbasename,meta_title,outgoing_links,{term:[positions]})] of
+    the pages with any of the words from the search_postings index. Only the
+    postings of the words are read. where and params are more predicates
+    (e.g. from compile_query)
+    """
+    words = sorted(set(words))
+    qmarks = list(words)
+    sql = '''SELECT search_postings.term,search_postings.doc,search_postings.positions,
+                    file_db.rootbasename,file_db.meta_title,file_db.outgoing_links
+             FROM search_postings JOIN file_db ON file_db.rowid = search_postings.doc
+             WHERE search_postings.term IN ({})'''.format(','.join('?' for _ in words))
+
+    if where:
+        sql += ' AND ' + where
+        qmarks.extend(params)
+
+    docs = OrderedDict()
+    for row in db.execute(sql,qmarks):
+        doc = docs.setdefault(row['doc'],(row['rootbasename'],row['meta_title'],
+                                          row['outgoing_links'],{}))
+        doc[3][row['term']] = json.loads(row['positions'])
+    return list(docs.values())
+
+def score_postings(docs,query_windows):
+    """
+    Yield (rootbasename,meta_title,score,outgoing_links) like score_pages
+    but with the window counts from the read_postings docs. Words match
+    whole words only
+    """
+    query_windows = [(window.split(),mult) for window,mult in query_windows]
+    for name,title,outgoing_links,doc_postings in docs:
+        score = 0
+        for window,mult in query_windows:
+            score += root(window_count(window,doc_postings),3) * mult
+        yield name,title,score,outgoing_links
+
+def get_authority(names,db,chunk=500):
+    """
+    Return {rootbasename:authority} for names from page_authority. Pages not
+    in it (e.g. new since the last update_authority) are left out
+    """
+    authority = {}
+    for ii in range(0,len(names),chunk):
+        subnames = names[ii:ii+chunk]
+        sql = '''SELECT rootbasename,authority FROM page_authority
+                 WHERE rootbasename IN ({})'''.format(','.join('?' for _ in subnames))
+        for row in db.execute(sql,subnames):
+            authority[row['rootbasename']] = row['authority']
+    return authority
+
+def update_authority(db,force=False,damping=0.85,tol=1e-6,maxiter=100):
+    """
+    Recompute the PageRank style authority of every page from file_links if
+    the links changed (triggers set authority_state.stale) or force. The
+    authority is scaled so the average page has 1.
+
+    This is always a full recompute: every page and link is read and each
+    iteration is over the whole graph. Starting from the stored authorities
+    only saves some iterations so callers that change a few pages at a time
+    should not call it for each change (see indexer.SourceWatcher).
+    Does not commit
+    """
+    if not force and not db.execute('SELECT stale FROM authority_state').fetchone()['stale']:
+        return
+
+    names = [row['rootbasename'] for row in db.execute('SELECT rootbasename FROM file_db')]
+    names = sorted(set(names))
+    N = len(names)
+    index = dict((name,ii) for ii,name in enumerate(names))
+
+    # ID links go to every page with that ID
+    outlinks = [set() for _ in names]
+    for row in db.execute("""
+            SELECT file_db.rootbasename AS source,
+                   COALESCE(file_links.target_rootbasename,target.rootbasename) AS target
+            FROM file_links
+            JOIN file_db ON file_db.rootname = file_links.source
+            LEFT JOIN file_db AS target ON target.meta_id = file_links.target_id"""):
+        if row['target'] in index and row['target'] != row['source']:
+            outlinks[index[row['source']]].add(index[row['target']])
+
+    old = get_authority(names,db)
+    rank = [old.get(name,1.0) for name in names]
+    total = sum(rank) or 1.0
+    rank = [r/total for r in rank]
+
+    for _ in range(maxiter if N > 0 else 0):
+        # Pages without links spread theirs evenly
+        dangling = sum(rank[ii] for ii in range(N) if not outlinks[ii])
+        new = [(1.0 - damping + damping*dangling)/N]*N
+        for ii in range(N):
+            if outlinks[ii]:
+                share = damping*rank[ii]/len(outlinks[ii])
+                for jj in outlinks[ii]:
+                    new[jj] += share
+        diff = sum(abs(a - b) for a,b in zip(new,rank))
+        rank = new
+        if diff < tol:
+            break
+
+    db.execute('DELETE FROM page_authority')
+    db.executemany('INSERT INTO page_authority VALUES (?,?)',
+                   [(name,N*r) for name,r in zip(names,rank)])
+    db.execute('UPDATE authority_state SET stale=0')
+    db.execute('UPDATE index_generation SET generation = generation + 1') # Scores changed
+
+def has_fts(db):
+    """Whether the DB has the search_fts (FTS5) table"""
+    return db.execute("""SELECT 1 FROM sqlite_master
+                         WHERE type='table' AND name='search_fts'""").fetchone() is not None
+
+def use_fts(db):
+    """
+    Whether search_fts is the search index in use. It is only kept up to
+    date (see write_items and update_search_fts in main) while it is, since
+    search_postings takes precedence
+    """
+    if NBCONFIG.search_postings and has_postings(db):
+        return False
+    return NBCONFIG.search_fts and has_fts(db)
+
+def candidates_like(words,db,where=None,params=()):
+    """
+    Legacy candidate pages (with rootbasename, meta_title, outgoing_links,
+    and stext) for the words: any page with a word anywhere in the stext or
+    title. Every row is scanned and words also match in the middle of other
+    words (score_pages then only counts whole words). The title is not
+    stemmed so a page with a plural only in its title can be missed. where
+    and params are more predicates (e.g. from compile_query)
+    """
     # We could just do `for page in db.execute('SELECT * FROM file_db'):`
     # and run this. But we will at least drop down the number of 
     # pages with some SQL 'like' queries. This is not perfect since
@@ -93,13 +524,13 @@ def search(query,db,loc=None):
     #        OR lower(meta_title) LIKE %word1%
     # but use "?" to ensure no SQL injection
     
-    query_wild_cards = query.split()
-    query_wild_cards = ['%{}%'.format(a) for a in query_wild_cards]
+    query_wild_cards = ['%{}%'.format(a) for a in words]
     
     # This is what gets filled later
     qmarks = []
     
-    sql = 'SELECT * FROM file_db WHERE '
+    sql = '''SELECT rootbasename,meta_title,outgoing_links,stext
+             FROM file_db JOIN file_search USING (rootname) WHERE '''
     
     # Add `stext LIKE ? `
     sql += ''.join([
@@ -111,74 +542,221 @@ def search(query,db,loc=None):
               ])
     qmarks.extend(query_wild_cards*2)
     
-    if loc: # add location
-        loc = loc = utils.join('/',os.path.dirname(loc),'%') # So it is just the /dir + wildcard
-        sql += ' AND (rootdirname LIKE ?)'
-        qmarks.append(loc)
-        
-    
-    for page in db.execute(sql,qmarks):
-        name = page['rootbasename']
-        text = page['stext']
-        #title = utils.clean_for_search(page.get('meta_title','')) # SLOW. Just use regular
-        title = page.get('meta_title','').lower()
-        
-        # Add the title the the text twice to count extra
-        text = ' '.join([title]*2) + ' ' + text
-        
-        # Scores are based on the length of the match. But do recall that
-        # matching 'A B' means you also matches 'A' and 'B'
-        score = 0
-        for window in query_windows:
-            qtext = window[0]
-            mult = window[1]
-            
-            ## Old system: One match
-            #score += (text.find(qtext)>=0) * mult
-            
-            ## New, Count number of matches
-            score += root(text.count(qtext),3) * mult
-
-        page_scores_direct[name] = score
-        
-        # Add this score to each outgoing link
-        outs = [os.path.splitext(it)[0] for it in page['outgoing_links'].split(',')]
-        for out in outs:
-            incoming_count[out]['count'] += 1
-            incoming_count[out]['score'] += score
-        
-    page_scores = []
-    for name in page_scores_direct.keys():
-        direct = page_scores_direct[name]
-        incoming = link_mult_fcn(incoming_count[name]['count']) * incoming_count[name]['score']
-        page_score = {  'name':name,
-                        'direct':direct,
-                        'incoming':incoming,
-                        'score':combine_score(direct,incoming)} 
-        page_scores.append(page_score)
+    if where:
+        sql += ' AND ' + where
+        qmarks.extend(params)
         
-    page_scores.sort(reverse=True,key=lambda a:(a['score'],a['direct'])) # Sort by overall score then direct score
+    return db.execute(sql,qmarks)
 
-    out = []
-    for page_score in page_scores[:20]:
-        score = page_score['score']
-        path = page_score['name']
-        # name = file_db.find_one(rootbasename=page_score['name'])['ref_name']
-        
-        name = db.execute("""SELECT meta_title 
-                             FROM file_db
-                             WHERE rootbasename=?""",[page_score['name']])\
-                             .fetchone()['meta_title']
-        
-        if score ==0:
-            break
-        out.append(FMT.format(path=path,name=name,score=score))
+def candidates_fts(words,db,where=None,params=()):
+    """
+    Candidate pages (same as candidates_like) from the search_fts index: any
+    page with one of the words in the (cleaned) title or stext. Only the
+    matching rows are read. Words must match whole words
+    """
+    match = ' OR '.join('"{}"'.format(word.replace('"','""')) for word in words)
+    qmarks = [match]
+    sql = '''SELECT file_db.rootbasename,file_db.meta_title,file_db.outgoing_links,
+                    search_fts.stext
+             FROM search_fts JOIN file_db ON file_db.rowid = search_fts.rowid
+             WHERE search_fts MATCH ?'''
 
-    if len(out) == 0:
-        return 'No results for "{}"'.format(query0)
+    if where:
+        sql += ' AND ' + where
+        qmarks.extend(params)
 
-    return '\n'.join(out)
-#     return page_scores
+    return db.execute(sql,qmarks)
+
+def candidates_filtered(db,where=None,params=()):
+    """
+    Pages (same as candidates_like but without stext) matching where and
+    params alone, for queries of only filters
+    """
+    sql = '''SELECT file_db.rootbasename,file_db.meta_title,file_db.outgoing_links
+             FROM file_db JOIN file_search USING (rootname)'''
+    if where:
+        sql += ' WHERE ' + where
+    return db.execute(sql,list(params))
+
+## Query language
+QUERY_FIELDS = ['title','tag','path','date','draft']
+
+# [-][field:](word|"phrase")
+re_query_term = re.compile(r'(-?)(?:([A-Za-z]+):)?("[^"]*"?|[^\s"]+)')
+re_query_date = re.compile(r'^(>=|<=|>|<|=)?(\d{4})(?:-(\d{1,2}))?(?:-(\d{1,2}))?$')
+
+def parse_query(query):
+    """
+    Parse the query language (see the top of this file) into a dict of
+        words     : Words to score, cleaned (utils.search_tokens), in order.
+                    The plain, phrase, and title: words
+        phrases   : [words] that must each be in the page in a row
+        title     : Words that must be in the title
+        not_title : Words that may not be in the title (-title:word)
+        exclude   : [words]. Pages with all of any of them are left out
+        filters   : [(sql,params)] predicates on file_db (tag:, path:,
+                    date:, and draft:)
+
+    Raises a ValueError for an invalid filter (e.g. date:yesterday)
+    """
+    parsed = {'words':[],'phrases':[],'title':[],'not_title':[],'exclude':[],'filters':[]}
+    for negate,field,value in re_query_term.findall(utils.to_unicode(query)):
+        quoted = value.startswith('"')
+        value = value.strip('"')
+        field = field.lower()
+        if field and field not in QUERY_FIELDS:
+            value = field + ':' + value # e.g. http://...
+            field = ''
+
+        if field in ['','title']:
+            words = list(utils.search_tokens(value))
+            if len(words) == 0:
+                continue
+            if field == 'title' and negate:
+                parsed['not_title'].extend(words)
+            elif field == 'title':
+                parsed['title'].extend(words)
+                parsed['words'].extend(words)
+            elif negate:
+                parsed['exclude'].append(words)
+            else:
+                if quoted:
+                    parsed['phrases'].append(words)
+                parsed['words'].extend(words)
+            continue
+
+        sql,params = QUERY_FILTERS[field](value)
+        if negate and field == 'date': # Undated pages are not in any period
+            sql = 'file_db.page_date IS NULL OR NOT ({})'.format(sql)
+        elif negate:
+            sql = 'NOT ({})'.format(sql)
+        parsed['filters'].append((sql,params))
+
+    return parsed
+
+def tag_filter(value):
+    return 'file_db.rootname IN (SELECT rootname FROM file_tags WHERE tag=?)',[utils.standard_tag(value)]
+
+def path_filter(value):
+    path = value.strip('/')
+    # Literal % and _ (e.g. path:50%_off). Still uses the (NOCASE) rootdirname
+    # index like `loc`
+    path = path.replace('\\','\\\\').replace('%','\\%').replace('_','\\_')
+    return "file_db.rootdirname LIKE ? ESCAPE '\\'",[utils.join('/',path,'%') if path else '/%']
+
+def date_filter(value):
+    match = re_query_date.match(value)
+    if not match:
+        raise ValueError('Invalid date filter "date:{}". Use YYYY, YYYY-MM, or YYYY-MM-DD '
+                         'optionally after >, >=, <, or <='.format(value))
+    op,year,month,day = match.groups()
+    try:
+        start = datetime(int(year),int(month or 1),int(day or 1))
+    except ValueError as E:
+        raise ValueError('Invalid date filter "date:{}": {}'.format(value,E))
+
+    # The period is [start,end)
+    if day:
+        end = start + timedelta(days=1)
+    elif month:
+        end = datetime(start.year + start.month//12,start.month % 12 + 1,1)
+    else:
+        end = datetime(start.year + 1,1,1)
+    start,end = [time.mktime(date.timetuple()) for date in (start,end)] # Same as page_date
+
+    if op == '>':
+        return 'file_db.page_date >= ?',[end]
+    if op == '>=':
+        return 'file_db.page_date >= ?',[start]
+    if op == '<':
+        return 'file_db.page_date < ?',[start]
+    if op == '<=':
+        return 'file_db.page_date < ?',[end]
+    return 'file_db.page_date >= ? AND file_db.page_date < ?',[start,end]
+
+def draft_filter(value):
+    value = value.lower()
+    if value in ['true','yes','1']:
+        return 'file_db.draft=1',[]
+    if value in ['false','no','0']:
+        return '+file_db.draft=0',[] # Not the draft index. See compile_query
+    raise ValueError('Invalid draft filter "draft:{}". Use yes or no'.format(value))
+
+QUERY_FILTERS = {'tag':tag_filter,'path':path_filter,'date':date_filter,'draft':draft_filter}
+
+def words_sql(words,backend,title=True,phrase=False):
+    """
+    Return (sql,params) of a predicate for pages with all of the words from
+    the backend's index ('postings', 'fts', or 'like'). 'like' is a scan of
+    file_search.stext (and, if title, a superset from the title). If phrase,
+    'fts' matches the words in order (an FTS5 phrase). The others still only
+    need all of them (query_matches checks the order)
+    """
+    if backend == 'postings':
+        sql = ' AND '.join(['file_db.rowid IN (SELECT doc FROM search_postings WHERE term=?)']*len(words))
+        return sql,list(words)
+    if backend == 'fts':
+        if phrase:
+            match = '"{}"'.format(' '.join(words).replace('"','""'))
+        else:
+            match = ' AND '.join('"{}"'.format(word.replace('"','""')) for word in words)
+        return 'file_db.rowid IN (SELECT rowid FROM search_fts WHERE search_fts MATCH ?)',[match]
+    sql,params = [],[]
+    for word in words:
+        if title:
+            sql.append("(instr(' ' || file_search.stext || ' ',?) > 0 OR lower(file_db.meta_title) LIKE ?)")
+            params.extend([' {} '.format(word),'%{}%'.format(word)])
+        else:
+            sql.append("instr(' ' || file_search.stext || ' ',?) > 0")
+            params.append(' {} '.format(word))
+    return ' AND '.join(sql),params
+
+def compile_query(parsed,backend,loc=None,drafts=True):
+    """
+    Return (sql,params) of the predicates (on file_db and file_search) every
+    result of the parse_query query must meet: the filters, loc, no drafts
+    unless drafts, all of the words of the phrases and title, and none of an
+    exclusion. query_matches then checks the phrase order and title exactly
+    """
+    preds = list(parsed['filters'])
+    if loc: # add location
+        loc = utils.join('/',os.path.dirname(loc),'%') # So it is just the /dir + wildcard
+        preds.append(('file_db.rootdirname LIKE ?',[loc]))
+    if not drafts:
+        # Unary + so the (unselective) draft index is never picked over the
+        # postings, tags, etc. (there are no ANALYZE stats to tell it apart)
+        preds.append(('+file_db.draft=0',[]))
+    for words in parsed['phrases']:
+        preds.append(words_sql(words,backend,phrase=True))
+    if parsed['title']:
+        preds.append(words_sql(parsed['title'],backend))
+    for words in parsed['exclude']:
+        sql,params = words_sql(words,backend,title=False)
+        preds.append(('NOT ({})'.format(sql),params))
+
+    sql = ' AND '.join('({})'.format(sql) for sql,_ in preds)
+    return sql,[param for _,params in preds for param in params]
+
+def query_matches(parsed,title,doc_postings):
+    """
+    Whether a candidate page with the title and postings {term:[positions]}
+    has the phrases (in order) and title words and not all of any exclusion.
+    Only terms in doc_postings are known (compile_query already has the SQL
+    for the others)
+    """
+    for words in parsed['phrases']:
+        if window_count(words,doc_postings) == 0:
+            return False
+    for words in parsed['exclude']:
+        if all(word in doc_postings for word in words):
+            return False
+    if parsed['title'] or parsed['not_title']:
+        title_words = set(utils.search_tokens(title or ''))
+        if not title_words.issuperset(parsed['title']):
+            return False
+        if title_words.intersection(parsed['not_title']):
+            return False
+    return True
 
 def all_window(seq,Nmin=1,Nmax=None):
     """
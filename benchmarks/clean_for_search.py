@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput (MB/s) of utils.clean_for_search, the text normalization run on
+every indexed page and every query, compared to the old pipeline (several
+regex passes, the NFKD round trip on all text, and a stop-word list scan per
+word). Also checks that both give the same text without stemming.
+
+The corpus is every .md, .html, and .ipynb file under the directory (e.g.
+the notebook source). Defaults to this repository
+
+    python benchmarks/clean_for_search.py [DIR]
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os,sys
+import re
+import io
+import timeit
+import unicodedata
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from NBweb import utils
+from NBweb import stop_words
+
+re_html = re.compile('\<.*?\>')
+re_alphanumeric = re.compile(r'[^\s\w_]+')
+re_multspace = re.compile('\s\s.*?([^\s])')
+
+def clean_for_search_old(text_html):
+    """ The old utils.clean_for_search """
+    text_html = utils.to_unicode(text_html)
+    text = re_html.sub(' ',text_html).replace('\n',' ').lower()
+    text = unicodedata.normalize('NFKD', text).encode('ascii','ignore')
+    text = utils.to_unicode(text)
+    text = re_alphanumeric.sub(' ',text)
+    text = re_multspace.sub(' \\1',text).strip()
+
+    add_stop = ['in','a','http','https']
+    text = ' '.join(word for word in text.split() if not word in stop_words.stop_words + add_stop and len(word)>=3)
+
+    return text
+
+def load_corpus(path):
+    texts = []
+    for dirpath,dirnames,filenames in os.walk(path):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if filename.endswith(('.md','.html','.ipynb')):
+                with io.open(os.path.join(dirpath,filename),encoding='utf8',errors='replace') as F:
+                    texts.append(F.read())
+    return texts
+
+def main(path=None,repeat=3):
+    path = path or os.path.join(os.path.dirname(os.path.abspath(__file__)),'..')
+    texts = load_corpus(path)
+    size = sum(len(text.encode('utf8')) for text in texts)/1e6
+
+    mismatch = sum(clean_for_search_old(text) != utils.clean_for_search(text,stem_words=False)
+                   for text in texts)
+
+    print('{} files, {:0.2f} MB, best of {}'.format(len(texts),size,repeat))
+    for name,fcn in [('old',clean_for_search_old),
+                     ('clean_for_search',lambda text: utils.clean_for_search(text,stem_words=False)),
+                     ('(stemmed)',lambda text: utils.clean_for_search(text,stem_words=True))]:
+        t = min(timeit.repeat(lambda: [fcn(text) for text in texts],number=1,repeat=repeat))
+        print('  {:<16s} {:8.2f} MB/s'.format(name,size/t))
+    print('  {} files with different output'.format(mismatch))
+
+if __name__ == '__main__':
+    main(*sys.argv[1:2])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark of the sqlite3 row factories: utils.dict_factory (the old
+OrderedDict per row), utils.row_factory, and sqlite3.Row for reference.
+
+Builds an in-memory file_db with N pages and times a full `SELECT *` (like
+the search scan) and the narrow rootbasename,todo query (like /_todo).
+
+row_factory only wins on the wide rows. On the narrow query it is about the
+same as dict_factory (slightly slower on small tables). See its docstring
+for why sqlite3.Row is not used.
+
+    python benchmarks/row_factory.py [N]
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os,sys
+import shutil
+import sqlite3
+import tempfile
+import timeit
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from NBweb import utils
+from NBweb.nbconfig import NBCONFIG
+
+# NBweb.main needs a parsed config. Use the defaults with a throwaway source
+_source = tempfile.mkdtemp()
+shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(utils.__file__)),'_NBweb'),
+                os.path.join(_source,'_NBweb')) # config and template.html
+NBCONFIG._parse(os.path.join(_source,'_NBweb','config'))
+
+from NBweb.main import SCHEMA
+
+def make_db(N):
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE file_db(' + ','.join(' '.join(s) for s in SCHEMA) + ')')
+    rows = []
+    for ii in range(N):
+        row = []
+        for name,sqltype in SCHEMA:
+            if name == 'rootname':
+                row.append('/dir/page{}.md'.format(ii))
+            elif sqltype.startswith(('int','real')):
+                row.append(ii)
+            else:
+                row.append('{} of page {}'.format(name,ii))
+        rows.append(row)
+    db.executemany('INSERT INTO file_db VALUES (' + ','.join('?' for _ in SCHEMA) + ')',rows)
+    db.commit()
+    return db
+
+def main(N=5000,repeat=5):
+    db = make_db(N)
+    factories = [('dict_factory',utils.dict_factory),
+                 ('row_factory',utils.row_factory),
+                 ('sqlite3.Row',sqlite3.Row)]
+    queries = [('SELECT *','SELECT * FROM file_db'),
+               ('SELECT 2 columns','SELECT rootbasename,todo FROM file_db')]
+
+    print('{} rows, best of {}'.format(N,repeat))
+    for qname,sql in queries:
+        print(qname)
+        base = None
+        for fname,factory in factories:
+            db.row_factory = factory
+            t = min(timeit.repeat(lambda: db.execute(sql).fetchall(),number=1,repeat=repeat))
+            base = base or t
+            print('  {:<14s} {:8.2f} ms  ({:0.2f}x)'.format(fname,1000*t,base/t))
+
+if __name__ == '__main__':
+    try:
+        main(*[int(a) for a in sys.argv[1:2]])
+    finally:
+        shutil.rmtree(_source,ignore_errors=True)
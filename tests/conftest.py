@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+NBweb.main needs a parsed config. The tests use the defaults with a throwaway
+source (removed at the end) that each test module adds its pages to
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+from io import open
+
+import os,sys
+import shutil
+import tempfile
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from NBweb import utils
+from NBweb.nbconfig import NBCONFIG
+
+_source = tempfile.mkdtemp()
+shutil.copytree(os.path.join(os.path.dirname(os.path.abspath(utils.__file__)),'_NBweb'),
+                os.path.join(_source,'_NBweb')) # config and template.html
+NBCONFIG._parse(os.path.join(_source,'_NBweb','config'))
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_source,ignore_errors=True)
+
+def write_page(rootname,text):
+    """Write text to rootname in the source. Returns the systempath"""
+    systempath = os.path.join(NBCONFIG.source,rootname.lstrip('/'))
+    if not os.path.isdir(os.path.dirname(systempath)):
+        os.makedirs(os.path.dirname(systempath))
+    with open(systempath,'wt',encoding='utf8') as F:
+        F.write(text)
+    return systempath
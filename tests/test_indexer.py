@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the background reindex (ReindexJob) queue. Pages are under /reindex
+in the conftest source.
+
+    python -m pytest tests
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import os
+
+import pytest
+
+from conftest import write_page
+from NBweb import main
+from NBweb import indexer
+
+def in_db(rootname,db):
+    return db.execute('SELECT 1 FROM file_db WHERE rootname=?',(rootname,)).fetchone() is not None
+
+@pytest.fixture
+def db():
+    main.init_db()
+    db = main.db_conn()
+    yield db
+    db.execute('DELETE FROM reindex_queue')
+    db.close()
+
+def test_purge_keeps_pages_added_during_job(db):
+    write_page('/reindex/kept.md','Title: Kept\n\ntext')
+    deleted = write_page('/reindex/deleted.md','Title: Deleted\n\ntext')
+    main.parse_all()
+    assert in_db('/reindex/deleted.md',db)
+
+    os.remove(deleted)
+    job = indexer.ReindexJob()
+    job._enqueue(db)
+
+    # e.g. saved in the editor while the job runs
+    added = write_page('/reindex/added.md','Title: Added\n\ntext')
+    main.parse_path(added,db)
+    db.commit()
+
+    job._process(db)
+    assert in_db('/reindex/kept.md',db)
+    assert in_db('/reindex/added.md',db)
+    assert not in_db('/reindex/deleted.md',db)
+
+def test_unchanged_but_missing_pages_are_parsed(db):
+    write_page('/reindex/missing.md','Title: Missing\n\ntext')
+    main.parse_all()
+    db.execute('DELETE FROM file_db WHERE rootname=?',('/reindex/missing.md',))
+    db.commit()
+
+    job = indexer.ReindexJob()
+    job._enqueue(db) # Same mtime so unchanged by the manifest
+    job._process(db)
+    assert in_db('/reindex/missing.md',db)
+
+def test_watcher_defers_authority(db):
+    systempath = write_page('/reindex/linked.md','Title: Linked\n\n[kept](kept.md)')
+    watcher = indexer.SourceWatcher()
+    watcher.process([systempath])
+    assert db.execute('SELECT stale FROM authority_state').fetchone()['stale']
+
+    watcher.update_authority()
+    assert not db.execute('SELECT stale FROM authority_state').fetchone()['stale']
+
+def test_watcher_ignored():
+    watcher = indexer.SourceWatcher()
+    dotted = os.path.dirname(write_page('/reindex/v1.2/page.md','Title: Page\n\ntext'))
+    assert not watcher._ignored(dotted)
+    assert not watcher._ignored(dotted + 'gone',isdir=True) # e.g. deleted
+    assert watcher._ignored(dotted + 'gone',isdir=False)
+    assert watcher._ignored(os.path.join(dotted,'notes.txt'))
+    assert not watcher._ignored(os.path.join(dotted,'page.md'))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of writing parsed pages to the DB. Pages are under /main in the
+conftest source.
+
+    python -m pytest tests
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import pytest
+
+from conftest import write_page
+from NBweb import main
+
+@pytest.fixture
+def db():
+    main.init_db()
+    db = main.db_conn()
+    yield db
+    db.close()
+
+def test_new_item_already_written(db):
+    # Another connection wrote the same new page first (see SQL_INSERT)
+    systempath = write_page('/main/race.md','Title: First\n\ntext')
+    main.write_items([(main.render_path(systempath),True)],db)
+    rowid = db.execute("SELECT rowid FROM file_db WHERE rootname='/main/race.md'").fetchone()['rowid']
+
+    write_page('/main/race.md','Title: Second\n\ntext')
+    main.write_items([(main.render_path(systempath),True)],db)
+    db.commit()
+
+    rows = db.execute("SELECT rowid,meta_title FROM file_db WHERE rootname='/main/race.md'").fetchall()
+    assert rows == [{'rowid':rowid,'meta_title':'Second'}]
+
+def test_dir_listings_do_not_write_deferred_rows(db):
+    write_page('/main/listed/page.md','Title: Listed\n\ntext')
+    listing = main.dir_listings('/main/listed/',db)
+    db.commit()
+
+    assert 'Listed' in listing
+    assert db.execute("SELECT 1 FROM file_db WHERE rootname='/main/listed/page.md'").fetchone() is None
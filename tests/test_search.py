@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the search: the query language, its SQL, and the tokenizer. Builds a
+small notebook in the conftest source.
+
+    python -m pytest tests
+"""
+from __future__ import division, print_function, unicode_literals, absolute_import
+
+import re
+
+import pytest
+
+from conftest import write_page
+from NBweb import main
+from NBweb import utils
+from NBweb import search
+
+PAGES = {
+    'dated.md'  : 'Title: Dated\nDate: 2020-01-02\n\nrareword about chickens',
+    'undated.md': 'Title: Undated\n\nrareword with no date',
+    'draft.md'  : 'Title: Secret\nDate: 2020-01-02\nDraft: true\n\nrareword in a draft',
+    '50%_off/sale.md' : 'Title: Sale\n\nbargain',
+    '50ab_off/sale.md': 'Title: Other sale\n\nbargain',
+}
+
+@pytest.fixture(scope='module')
+def db():
+    for rootname,text in PAGES.items():
+        write_page(rootname,text)
+    main.init_db()
+    main.parse_all()
+    yield main.db_conn()
+    main.db_conn().close()
+
+def found(query,db,drafts=False):
+    """rootbasenames of the results of query"""
+    results,_ = search.search_results(search.parse_query(query),db,drafts=drafts)
+    return set(re.search(r'href="(.*?)\.html"',result).group(1) for result in results)
+
+class RecordingDB(object):
+    """Pass through to db but record every SELECT"""
+    def __init__(self,db):
+        self.db = db
+        self.queries = []
+
+    def execute(self,sql,params=()):
+        if sql.strip().upper().startswith('SELECT'):
+            self.queries.append((sql,params))
+        return self.db.execute(sql,params)
+
+    def __getattr__(self,attr):
+        return getattr(self.db,attr)
+
+@pytest.mark.parametrize('query',['rareword','rareword chickens','tag:none','date:2020'])
+def test_public_search_does_not_use_draft_index(db,query):
+    rec = RecordingDB(db)
+    search.search_results(search.parse_query(query),rec,drafts=False)
+    assert rec.queries
+    for sql,params in rec.queries:
+        plan = ' '.join(str(row['detail']) for row in
+                        db.execute('EXPLAIN QUERY PLAN ' + sql,params).fetchall())
+        assert 'idx_file_db_draft' not in plan, (sql,plan)
+
+def test_drafts(db):
+    assert found('rareword',db) == {'/dated','/undated'}
+    assert found('rareword',db,drafts=True) == {'/dated','/undated','/draft'}
+    assert found('rareword draft:yes',db,drafts=True) == {'/draft'}
+
+def test_date(db):
+    assert found('rareword date:2020',db) == {'/dated'}
+    assert found('rareword date:>=2021',db) == set()
+    # Undated pages are not *in* 2020 either
+    assert found('rareword -date:2020',db) == {'/undated'}
+    assert found('rareword -date:<2019',db) == {'/dated','/undated'}
+
+@pytest.mark.parametrize('word,stemmed',[
+    ('queries','query'),('cats','cat'),('notes','note'),('cases','case'),
+    ('boxes','box'),('processes','process'),('classes','class'),
+    ('matches','match'),('wishes','wish'),('buzzes','buzz'),
+    ('series','series'),('species','species'),('news','news'),('caches','cache'),
+    ('status','status'),('class','class'),('box','box'),('its','its'),
+])
+def test_stem(word,stemmed):
+    assert utils.stem(word) == stemmed
+
+def test_stem_matches_singular_and_plural():
+    for singular,plural in [('box','boxes'),('process','processes'),('query','queries'),
+                            ('match','matches'),('cache','caches'),('file','files')]:
+        assert utils.stem(singular) == utils.stem(plural)
+
+def test_fts_phrase(db,monkeypatch):
+    if not search.has_fts(db):
+        pytest.skip('SQLite without FTS5')
+    monkeypatch.setattr(search.NBCONFIG,'search_postings',False)
+    main.update_search_fts(db) # Now in use
+    try:
+        def matched(query):
+            where,params = search.compile_query(search.parse_query(query),'fts')
+            return set(row['rootbasename'] for row in db.execute(
+                'SELECT rootbasename FROM file_db WHERE ' + where,params))
+        assert matched('"rareword chickens"') == {'/dated'}
+        assert matched('"chickens rareword"') == set() # In the SQL, not just query_matches
+        assert found('"rareword chickens"',db) == {'/dated'}
+    finally:
+        monkeypatch.undo()
+        main.update_search_fts(db)
+
+def test_path_is_literal(db):
+    assert found('bargain',db) == {'/50%_off/sale','/50ab_off/sale'}
+    assert found('bargain path:50%_off',db) == {'/50%_off/sale'}
+    assert found('bargain -path:50%_off',db) == {'/50ab_off/sale'}
+    assert found('path:50ab_off',db) == {'/50ab_off/sale'}